@@ -1,10 +1,21 @@
 import os
+import time
+import asyncio
+import heapq
+import itertools
 import logging
 import json
-from telegram import Update, ReplyKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from datetime import datetime
-from collections import defaultdict
+import math
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.error import RetryAfter, NetworkError, BadRequest
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta, time as dtime
+from collections import defaultdict, deque, OrderedDict
+from charts import render_chart_png
 
 # Настройка логирования
 logging.basicConfig(
@@ -15,10 +26,806 @@ logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 
+# Время ночной заморозки агрегатов за прошедший день
+ROLLUP_TIME = dtime(0, 5)
+
+def empty_totals():
+    """Пустые агрегаты по группе товаров"""
+    return {
+        'count': 0,
+        'total_cost': 0,
+        'total_expenses': 0,
+        'total_final': 0,
+        'total_profit': 0
+    }
+
+def add_to_totals(totals, product, sign=1):
+    """Учет товара в агрегатах (sign=-1 - исключение)"""
+    totals['count'] += sign
+    totals['total_cost'] += sign * product['cost']
+    totals['total_expenses'] += sign * product['expenses']
+    totals['total_final'] += sign * product['final_price']
+    totals['total_profit'] += sign * product['profit']
+
+def merge_totals(totals, other):
+    """Сложение двух агрегатов"""
+    for key in totals:
+        totals[key] += other[key]
+
+def product_tag(product):
+    """Тег товара ('' - без тега; у старых товаров поля нет)"""
+    return product.get('tag') or ''
+
+def tag_cells(products):
+    """Ячейки куба (дата -> тег -> агрегаты) по списку товаров"""
+    cells = {}
+    for product in products:
+        add_to_totals(cells.setdefault(product['date'], {}).setdefault(product_tag(product), empty_totals()), product)
+    return cells
+
+class TagCube:
+    """Куб агрегатов по (дата, тег): группировки по тегам без просмотра товаров"""
+    def __init__(self):
+        self.cells = {}   # дата -> {тег -> агрегаты}
+        self.by_tag = {}  # тег -> агрегаты за все время
+        self._dates = []  # отсортированные даты, по которым есть ячейки
+    
+    def rebuild(self, cells_list):
+        """Пересборка куба из готовых ячеек (агрегатов сегментов и горячих товаров)"""
+        self.cells = {}
+        self.by_tag = {}
+        for cells in cells_list:
+            for date, tags in cells.items():
+                for tag, totals in tags.items():
+                    merge_totals(self.cells.setdefault(date, {}).setdefault(tag, empty_totals()), totals)
+                    merge_totals(self.by_tag.setdefault(tag, empty_totals()), totals)
+        self._dates = sorted(self.cells)
+    
+    def apply(self, product, sign):
+        """Учет товара в кубе (sign=-1 - исключение)"""
+        date, tag = product['date'], product_tag(product)
+        if date not in self.cells:
+            self.cells[date] = {}
+            insort(self._dates, date)
+        
+        cell = self.cells[date].setdefault(tag, empty_totals())
+        total = self.by_tag.setdefault(tag, empty_totals())
+        add_to_totals(cell, product, sign)
+        add_to_totals(total, product, sign)
+        
+        # Опустевшие ячейки убираем, чтобы в отчетах не было пустых групп
+        if cell['count'] == 0:
+            del self.cells[date][tag]
+            if not self.cells[date]:
+                del self.cells[date]
+                del self._dates[bisect_left(self._dates, date)]
+        if total['count'] == 0:
+            del self.by_tag[tag]
+    
+    def group_by_tag(self, start_date=None, end_date=None):
+        """Агрегаты по тегам за все время или за диапазон дат"""
+        if start_date is None:
+            return {tag: dict(totals) for tag, totals in self.by_tag.items()}
+        
+        result = {}
+        for date in self._range(start_date, end_date):
+            for tag, totals in self.cells[date].items():
+                merge_totals(result.setdefault(tag, empty_totals()), totals)
+        return result
+    
+    def drill_down(self, tag, start_date=None, end_date=None):
+        """Агрегаты тега по дням: [(дата, агрегаты)]"""
+        return [
+            (date, dict(self.cells[date][tag]))
+            for date in self._range(start_date, end_date)
+            if tag in self.cells[date]
+        ]
+    
+    def tags(self):
+        """Теги по убыванию числа товаров"""
+        return sorted((tag for tag in self.by_tag if tag), key=lambda tag: -self.by_tag[tag]['count'])
+    
+    def _range(self, start_date, end_date):
+        if start_date is None:
+            return self._dates
+        return self._dates[bisect_left(self._dates, start_date):bisect_right(self._dates, end_date)]
+
+class RollupStore:
+    """Замороженные дневные и месячные агрегаты по завершившимся дням"""
+    def __init__(self, data_file='rollups.json'):
+        self.data_file = data_file
+        self.dirty = False
+        self.load_data()
+    
+    def load_data(self):
+        """Загрузка агрегатов из JSON файла"""
+        try:
+            if os.path.exists(self.data_file):
+                with open(self.data_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.frozen_until = data['frozen_until']
+                self.daily = data['daily']
+                self.monthly = data['monthly']
+            else:
+                self.frozen_until = None
+                self.daily = {}
+                self.monthly = {}
+        except Exception as e:
+            logger.error(f"Ошибка загрузки агрегатов: {e}")
+            self.frozen_until = None
+            self.daily = {}
+            self.monthly = {}
+    
+    def save_data(self):
+        """Сохранение агрегатов в JSON файл"""
+        try:
+            data = {
+                'frozen_until': self.frozen_until,
+                'daily': self.daily,
+                'monthly': self.monthly
+            }
+            with open(self.data_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            self.dirty = False
+        except Exception as e:
+            logger.error(f"Ошибка сохранения агрегатов: {e}")
+    
+    def is_frozen(self, date):
+        """День уже заморожен (все дни раньше frozen_until)"""
+        return self.frozen_until is not None and date < self.frozen_until
+    
+    def freeze(self, products, until_date):
+        """Заморозка агрегатов по всем дням раньше until_date, возвращает новые дни"""
+        if self.frozen_until is not None and until_date <= self.frozen_until:
+            return []
+        
+        new_days = {}
+        # Товары добавляются в хронологическом порядке, поэтому идем с конца
+        # и останавливаемся на первом уже замороженном дне
+        for product in reversed(products):
+            date = product['date']
+            if self.is_frozen(date):
+                break
+            if date < until_date:
+                add_to_totals(new_days.setdefault(date, empty_totals()), product)
+        
+        self.daily.update(new_days)
+        
+        # Месяц замораживается целиком, когда прошел его последний день
+        months = {date[:7] for date in new_days}
+        if self.frozen_until:
+            months.add(self.frozen_until[:7])
+        
+        for month in sorted(months):
+            if month < until_date[:7] and month not in self.monthly:
+                totals = empty_totals()
+                for date, day_totals in self.daily.items():
+                    if date.startswith(month):
+                        merge_totals(totals, day_totals)
+                self.monthly[month] = totals
+        
+        self.frozen_until = until_date
+        self.save_data()
+        return sorted(new_days)
+    
+    def restore(self, cells_list):
+        """Восстановление агрегатов архивных дней из кубов сегментов (если файл агрегатов потерян)"""
+        for cells in cells_list:
+            for date, tags in cells.items():
+                day_totals = self.daily.setdefault(date, empty_totals())
+                month_totals = self.monthly.setdefault(date[:7], empty_totals())
+                for totals in tags.values():
+                    merge_totals(day_totals, totals)
+                    merge_totals(month_totals, totals)
+        self.dirty = True
+    
+    def apply(self, product, sign):
+        """Поправка замороженных агрегатов при изменении или удалении старого товара"""
+        date = product['date']
+        if not self.is_frozen(date):
+            return
+        
+        day_totals = self.daily.setdefault(date, empty_totals())
+        add_to_totals(day_totals, product, sign)
+        if day_totals['count'] == 0:
+            del self.daily[date]
+        
+        if date[:7] in self.monthly:
+            add_to_totals(self.monthly[date[:7]], product, sign)
+        
+        self.dirty = True
+    
+    def get_totals(self):
+        """Сумма всех замороженных агрегатов"""
+        totals = empty_totals()
+        for month_totals in self.monthly.values():
+            merge_totals(totals, month_totals)
+        
+        # Дни текущего, еще не замороженного целиком месяца
+        if self.frozen_until and self.frozen_until[:7] not in self.monthly:
+            month_start = datetime.strptime(self.frozen_until[:7] + '-01', '%Y-%m-%d')
+            day = month_start
+            while day.strftime('%Y-%m-%d') < self.frozen_until:
+                day_totals = self.daily.get(day.strftime('%Y-%m-%d'))
+                if day_totals:
+                    merge_totals(totals, day_totals)
+                day += timedelta(days=1)
+        
+        return totals
+
+def product_margin(product):
+    """Рентабельность товара в процентах"""
+    return product['profit'] / product['final_price'] * 100 if product['final_price'] > 0 else 0.0
+
+# Рейтинги товаров: название, сортируемое значение и порядок (True - по убыванию)
+RANKINGS = {
+    'top_profit': ('💰 Самые прибыльные', lambda p: p['profit'], True),
+    'low_profit': ('📉 Наименее прибыльные', lambda p: p['profit'], False),
+    'top_expenses': ('💸 Наибольшие расходы', lambda p: p['expenses'], True),
+    'low_margin': ('⚠️ Худшая рентабельность', product_margin, False),
+}
+
+def ranking_key(ranking, product):
+    """Ключ сортировки товара в рейтинге (меньше - выше)"""
+    _, value, descending = RANKINGS[ranking]
+    return -value(product) if descending else value(product)
+
+class RankingIndex:
+    """Кучи по прибыли, расходам и рентабельности для топ-N без полной сортировки"""
+    def __init__(self):
+        self._seq = itertools.count()
+        self.rebuild([])
+    
+    def rebuild(self, products):
+        """Полная пересборка куч"""
+        self._live = {}  # id(товара) -> (актуальная ревизия, товар)
+        self._stale = 0
+        self._heaps = {name: [] for name in RANKINGS}
+        self._day_heaps = {}
+        self._dates = []
+        
+        for product in products:
+            self._push(product, keep_heap=False)
+        
+        for heaps in [self._heaps, *self._day_heaps.values()]:
+            for heap in heaps.values():
+                heapq.heapify(heap)
+    
+    def add(self, product):
+        """Учет нового или измененного товара"""
+        self._push(product)
+    
+    def remove(self, product):
+        """Исключение товара: записи в кучах устаревают и пропускаются при чтении"""
+        if self._live.pop(id(product), None) is None:
+            return
+        
+        self._stale += 1
+        # Устаревших записей стало больше живых - дешевле пересобрать кучи
+        if self._stale > len(self._live) + 64:
+            self.rebuild([product for _, product in self._live.values()])
+    
+    def _push(self, product, keep_heap=True):
+        rev = next(self._seq)
+        self._live[id(product)] = (rev, product)
+        
+        date = product['date']
+        if date not in self._day_heaps:
+            self._day_heaps[date] = {name: [] for name in RANKINGS}
+            insort(self._dates, date)
+        
+        for name in RANKINGS:
+            entry = (ranking_key(name, product), rev, product)
+            for heap in (self._heaps[name], self._day_heaps[date][name]):
+                if keep_heap:
+                    heapq.heappush(heap, entry)
+                else:
+                    heap.append(entry)
+    
+    def top(self, ranking, n=10, start_date=None, end_date=None):
+        """Первые n товаров рейтинга, глобально или за диапазон дат"""
+        if start_date is None:
+            heaps = [self._heaps[ranking]]
+        else:
+            lo = bisect_left(self._dates, start_date)
+            hi = bisect_right(self._dates, end_date)
+            heaps = [self._day_heaps[date][ranking] for date in self._dates[lo:hi]]
+        
+        # Обход куч в порядке возрастания без их изменения: из кандидатов
+        # берем лучший и добавляем его потомков, это O(n log n) от размера ответа
+        frontier = [(heap[0], i, 0) for i, heap in enumerate(heaps) if heap]
+        heapq.heapify(frontier)
+        
+        result = []
+        while frontier and len(result) < n:
+            entry, heap_idx, idx = heapq.heappop(frontier)
+            _, rev, product = entry
+            if self._live.get(id(product), (None,))[0] == rev:
+                result.append(product)
+            
+            heap = heaps[heap_idx]
+            for child in (2 * idx + 1, 2 * idx + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], heap_idx, child))
+        
+        return result
+
+# Архивные сегменты: сколько держать в памяти и через сколько секунд простоя выгружать
+SEGMENT_CACHE_SIZE = 2
+SEGMENT_IDLE_SECONDS = 600
+# Сколько лучших товаров каждого рейтинга хранится в агрегатах сегмента
+SEGMENT_TOP_K = 20
+
+class SegmentStore:
+    """Архив закрытых месяцев: неизменяемые файлы-сегменты с агрегатами, загружаемые по требованию"""
+    def __init__(self, data_dir='segments'):
+        self.data_dir = data_dir
+        self.manifest_file = os.path.join(data_dir, 'manifest.json')
+        self._cache = OrderedDict()  # месяц -> (товары, время последнего обращения)
+        self.load_data()
+    
+    def load_data(self):
+        """Загрузка описи сегментов"""
+        try:
+            if os.path.exists(self.manifest_file):
+                with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                    self.segments = json.load(f)
+            else:
+                self.segments = []
+        except Exception as e:
+            logger.error(f"Ошибка загрузки описи сегментов: {e}")
+            self.segments = []
+        self._rebuild_offsets()
+    
+    def save_data(self):
+        """Сохранение описи сегментов"""
+        try:
+            os.makedirs(self.data_dir, exist_ok=True)
+            with open(self.manifest_file, 'w', encoding='utf-8') as f:
+                json.dump(self.segments, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения описи сегментов: {e}")
+    
+    def _rebuild_offsets(self):
+        self._positions = {meta['month']: i for i, meta in enumerate(self.segments)}
+        self._offsets = []
+        total = 0
+        for meta in self.segments:
+            self._offsets.append(total)
+            total += meta['count']
+        self.total_count = total
+    
+    def __contains__(self, month):
+        return month in self._positions
+    
+    def offset(self, month):
+        """Сколько архивных товаров лежит до сегмента"""
+        return self._offsets[self._positions[month]]
+    
+    def locate(self, position):
+        """Месяц сегмента и позиция в нем для сквозной позиции товара"""
+        idx = bisect_right(self._offsets, position) - 1
+        return self.segments[idx]['month'], position - self._offsets[idx]
+    
+    def refs(self):
+        """Ссылки на текущие версии сегментов (для снимков журнала)"""
+        return [{'month': meta['month'], 'file': meta['file']} for meta in self.segments]
+    
+    def read_file(self, file_name):
+        """Чтение сегмента с диска в обход кэша"""
+        with open(os.path.join(self.data_dir, file_name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def load(self, month):
+        """Товары сегмента с актуальными ID, недавно открытые сегменты берутся из кэша"""
+        if month in self._cache:
+            products = self._cache.pop(month)[0]
+        else:
+            products = self.read_file(self.segments[self._positions[month]]['file'])
+            logger.info(f"📂 Загружен архивный сегмент {month}")
+        self._remember(month, products)
+        
+        for i, product in enumerate(products, self.offset(month) + 1):
+            product['id'] = i
+        return products
+    
+    def write(self, month, products):
+        """Запись новой версии сегмента вместе с агрегатами"""
+        old_meta = self.segments[self._positions[month]] if month in self else None
+        version = old_meta['version'] + 1 if old_meta else 1
+        file_name = f'{month}.v{version}.json'
+        
+        top = {
+            name: heapq.nsmallest(
+                SEGMENT_TOP_K,
+                ([ranking_key(name, product), idx, product] for idx, product in enumerate(products)),
+                key=lambda entry: entry[0]
+            )
+            for name in RANKINGS
+        }
+        
+        meta = {
+            'month': month,
+            'version': version,
+            'file': file_name,
+            'count': len(products),
+            'first_date': products[0]['date'] if products else None,
+            'last_date': products[-1]['date'] if products else None,
+            'top': top,
+            'cube': tag_cells(products)
+        }
+        
+        try:
+            os.makedirs(self.data_dir, exist_ok=True)
+            with open(os.path.join(self.data_dir, file_name), 'w', encoding='utf-8') as f:
+                json.dump(products, f, ensure_ascii=False)
+        except Exception as e:
+            logger.error(f"Ошибка записи сегмента {month}: {e}")
+            return
+        
+        if old_meta:
+            self.segments[self._positions[month]] = meta
+        else:
+            self.segments.append(meta)
+            self.segments.sort(key=lambda m: m['month'])
+        
+        self._rebuild_offsets()
+        self.save_data()
+        self._cache.pop(month, None)
+        self._remember(month, products)
+    
+    def collect_garbage(self, pinned):
+        """Удаление версий сегментов, на которые не ссылаются ни опись, ни снимки журнала"""
+        live = {meta['file'] for meta in self.segments} | set(pinned)
+        removed = []
+        for file_name in os.listdir(self.data_dir) if os.path.isdir(self.data_dir) else ():
+            if file_name == 'manifest.json' or file_name in live:
+                continue
+            try:
+                os.remove(os.path.join(self.data_dir, file_name))
+                removed.append(file_name)
+            except Exception as e:
+                logger.error(f"Ошибка удаления версии сегмента {file_name}: {e}")
+        return removed
+    
+    def evict_idle(self, max_age):
+        """Выгрузка сегментов, к которым давно не обращались"""
+        now = time.monotonic()
+        idle = [month for month, (_, accessed) in self._cache.items() if now - accessed > max_age]
+        for month in idle:
+            del self._cache[month]
+        return idle
+    
+    def _remember(self, month, products):
+        self._cache[month] = (products, time.monotonic())
+        while len(self._cache) > SEGMENT_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+def apply_field_update(product, field, value):
+    """Изменение поля товара с пересчетом прибыли"""
+    if field == 'cost':
+        product['cost'] = float(value)
+    elif field == 'expenses':
+        product['expenses'] = float(value)
+    elif field == 'final_price':
+        product['final_price'] = float(value)
+    elif field == 'name':
+        product['name'] = value
+    elif field == 'tag':
+        product['tag'] = value
+    
+    # Пересчитываем прибыль при изменении числовых полей
+    if field in ['cost', 'expenses', 'final_price']:
+        product['profit'] = product['final_price'] - product['cost'] - product['expenses']
+
+def insert_product(products, product, index):
+    """Вставка товара на прежнее место без нарушения порядка по датам"""
+    lo = bisect_left(products, product['date'], key=lambda p: p['date'])
+    hi = bisect_right(products, product['date'], key=lambda p: p['date'])
+    products.insert(min(max(index, lo), hi), product)
+
+def apply_event(products, event):
+    """Применение события к списку товаров при восстановлении состояния"""
+    kind = event['type']
+    if kind in ('add', 'restore'):
+        insert_product(products, dict(event['product']), event['index'])
+        return
+    
+    for idx, product in enumerate(products):
+        if product.get('uid') == event.get('uid'):
+            if kind == 'update':
+                apply_field_update(product, event['field'], event['new'])
+                product['updated_at'] = event['ts']
+            elif kind == 'delete':
+                del products[idx]
+            return
+
+# Снимок состояния делается каждые SNAPSHOT_INTERVAL событий
+SNAPSHOT_INTERVAL = 100
+# Глубина /undo для одного пользователя
+MAX_UNDO = 20
+
+class EventLog:
+    """Неизменяемый журнал изменений товаров со снимками состояния"""
+    def __init__(self, segments, data_file='events.jsonl', snapshots_dir='snapshots'):
+        self.segments = segments
+        self.data_file = data_file
+        self.snapshots_dir = snapshots_dir
+        self.index_file = os.path.join(snapshots_dir, 'index.json')
+        self.seq = 0
+        self.snapshots = []
+        self.undo_stacks = {}
+        self.segment_files = set()  # версии сегментов, на которые ссылаются снимки
+    
+    def open(self, state):
+        """Загрузка последнего снимка и хвоста журнала после него"""
+        try:
+            if os.path.exists(self.index_file):
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    self.snapshots = json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки индекса снимков: {e}")
+            self.snapshots = []
+        
+        for meta in self.snapshots:
+            # В индексе старых снимков ссылок на сегменты нет - берем из самого снимка
+            files = meta.get('segment_files')
+            if files is None:
+                files = [ref['file'] for ref in self._load_snapshot(meta).get('segments', [])]
+            self.segment_files.update(files)
+        
+        if not self.snapshots:
+            # Истории до появления журнала нет - стартовый снимок текущих данных
+            self.snapshot(state, bootstrap=True)
+            return
+        
+        snapshot = self._load_snapshot(self.snapshots[-1])
+        self.seq = snapshot['seq']
+        self.undo_stacks = snapshot['undo_stacks']
+        for event in self._read_events(snapshot['offset']):
+            self.seq = event['seq']
+            self._track_undo(event)
+    
+    def record(self, kind, user_id, state, undo_of=None, **payload):
+        """Запись события в журнал, state() отдает состояние для снимка"""
+        self.seq += 1
+        event = {
+            'seq': self.seq,
+            'ts': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'type': kind,
+            'user_id': user_id,
+            **payload
+        }
+        if undo_of is not None:
+            event['undo_of'] = undo_of
+        
+        try:
+            with open(self.data_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(event, ensure_ascii=False) + '\n')
+        except Exception as e:
+            logger.error(f"Ошибка записи события: {e}")
+        
+        self._track_undo(event)
+        
+        if self.seq - self.snapshots[-1]['seq'] >= SNAPSHOT_INTERVAL:
+            self.snapshot(state)
+        return event
+    
+    def snapshot(self, state, bootstrap=False):
+        """Снимок текущего состояния, от него начинается восстановление"""
+        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        file_name = f'snapshot_{self.seq:08d}.json'
+        data = state()
+        meta = {
+            'seq': self.seq,
+            'ts': ts,
+            'offset': os.path.getsize(self.data_file) if os.path.exists(self.data_file) else 0,
+            'file': file_name,
+            'bootstrap': bootstrap,
+            'segment_files': [ref['file'] for ref in data.get('segments', [])]
+        }
+        
+        try:
+            os.makedirs(self.snapshots_dir, exist_ok=True)
+            with open(os.path.join(self.snapshots_dir, file_name), 'w', encoding='utf-8') as f:
+                json.dump({**meta, **data, 'undo_stacks': self.undo_stacks}, f, ensure_ascii=False)
+            
+            self.snapshots.append(meta)
+            self.segment_files.update(meta['segment_files'])
+            with open(self.index_file, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshots, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения снимка: {e}")
+    
+    def last_change(self, user_id):
+        """Последнее неотмененное изменение пользователя"""
+        stack = self.undo_stacks.get(str(user_id))
+        return stack[-1] if stack else None
+    
+    def state_as_of(self, ts):
+        """Список товаров на момент ts: ближайший снимок плюс события после него"""
+        idx = bisect_right([meta['ts'] for meta in self.snapshots], ts)
+        meta = self.snapshots[max(idx - 1, 0)]
+        snapshot = self._load_snapshot(meta)
+        
+        # Архивные месяцы снимок хранит ссылками на неизменяемые версии сегментов
+        products = []
+        for ref in snapshot.get('segments', []):
+            products.extend(self.segments.read_file(ref['file']))
+        products.extend(snapshot['products'])
+        
+        if snapshot['bootstrap']:
+            # До журнала известны только даты создания товаров
+            products = [p for p in products if p['created_at'] <= ts]
+        
+        for event in self._read_events(meta['offset']):
+            if event['ts'] > ts:
+                break
+            apply_event(products, event)
+        
+        for i, product in enumerate(products, 1):
+            product['id'] = i
+        return products
+    
+    def _track_undo(self, event):
+        if event['user_id'] is None:
+            return
+        
+        stack = self.undo_stacks.setdefault(str(event['user_id']), [])
+        if 'undo_of' in event:
+            if stack and stack[-1]['seq'] == event['undo_of']:
+                stack.pop()
+        elif event['type'] in ('add', 'update', 'delete'):
+            stack.append(event)
+            del stack[:-MAX_UNDO]
+    
+    def _load_snapshot(self, meta):
+        with open(os.path.join(self.snapshots_dir, meta['file']), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
+    def _read_events(self, offset):
+        if not os.path.exists(self.data_file):
+            return
+        with open(self.data_file, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+# Повторное оповещение по тому же правилу не раньше чем через ALERT_COOLDOWN секунд
+ALERT_COOLDOWN = 3600
+# Сколько дней хранить состояние сработавших оповещений
+ALERT_STATE_DAYS = 7
+
+def alert_state_cutoff():
+    """Первый день, за который хранится состояние оповещений"""
+    return (datetime.now() - timedelta(days=ALERT_STATE_DAYS)).strftime("%Y-%m-%d")
+
+class AlertManager:
+    """Правила оповещений по чатам и их состояние"""
+    def __init__(self, data_file='alerts.json'):
+        self.data_file = data_file
+        # notify(chat_id, kind, date, details) подставляется при запуске бота
+        self.notify = None
+        self.load_data()
+    
+    def load_data(self):
+        """Загрузка правил и состояния из JSON файла"""
+        try:
+            if os.path.exists(self.data_file):
+                with open(self.data_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.rules = data['rules']
+                self.state = data['state']
+            else:
+                self.rules = {}
+                self.state = {}
+        except Exception as e:
+            logger.error(f"Ошибка загрузки оповещений: {e}")
+            self.rules = {}
+            self.state = {}
+    
+    def save_data(self):
+        """Сохранение правил и состояния в JSON файл"""
+        # Состояние за старые дни больше не понадобится
+        cutoff = alert_state_cutoff()
+        for chat_state in self.state.values():
+            for key in [k for k in chat_state if k.split(':')[1] < cutoff]:
+                del chat_state[key]
+        
+        try:
+            with open(self.data_file, 'w', encoding='utf-8') as f:
+                json.dump({'rules': self.rules, 'state': self.state}, f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения оповещений: {e}")
+    
+    def get_rules(self, chat_id):
+        """Правила чата"""
+        return self.rules.get(str(chat_id), {'loss': False, 'margin': None, 'budget': None})
+    
+    def set_rule(self, chat_id, rule, value):
+        """Включение или отключение правила (value=None отключает)"""
+        rules = self.rules.setdefault(str(chat_id), {'loss': False, 'margin': None, 'budget': None})
+        rules[rule] = value
+        if not any(v not in (None, False) for v in rules.values()):
+            del self.rules[str(chat_id)]
+        self.save_data()
+    
+    def evaluate(self, product, day_totals):
+        """Проверка правил после изменения товара: O(1) на чат, без пересчета истории"""
+        if not self.rules:
+            return
+        
+        date = product['date']
+        # Состояние таких дней не хранится, и без него правки старых товаров оповещали бы каждый раз
+        if date < alert_state_cutoff():
+            return
+        
+        margin = day_totals['total_profit'] / day_totals['total_final'] * 100 if day_totals['total_final'] > 0 else 0
+        changed = False
+        
+        for chat_id, rules in self.rules.items():
+            checks = []
+            if rules['loss']:
+                checks.append((f"loss:{date}:{product['uid']}", product['profit'] < 0, 'loss', product))
+            if rules['margin'] is not None:
+                below = day_totals['count'] > 0 and margin < rules['margin']
+                checks.append((f"margin:{date}", below, 'margin', {'margin': margin, 'threshold': rules['margin']}))
+            if rules['budget'] is not None:
+                over = day_totals['total_expenses'] > rules['budget']
+                checks.append((f"budget:{date}", over, 'budget', {'expenses': day_totals['total_expenses'], 'budget': rules['budget']}))
+            
+            for key, triggered, kind, details in checks:
+                changed |= self._update_state(chat_id, key, triggered, kind, date, details)
+        
+        if changed:
+            self.save_data()
+    
+    def _update_state(self, chat_id, key, triggered, kind, date, details):
+        chat_state = self.state.setdefault(chat_id, {})
+        entry = chat_state.get(key)
+        
+        if not triggered:
+            # Условие ушло - правило снова может сработать
+            if entry and entry['active']:
+                entry['active'] = False
+                return True
+            return False
+        
+        now = time.time()
+        if entry and (entry['active'] or now - entry['fired_at'] < ALERT_COOLDOWN):
+            return False
+        
+        chat_state[key] = {'active': True, 'fired_at': now}
+        if self.notify:
+            self.notify(chat_id, kind, date, details)
+        return True
+
 class ProductManager:
+    """Товары: текущий и прошлый месяц в памяти, более старые - в архивных сегментах"""
     def __init__(self):
         self.data_file = 'products.json'
+        self.rollups = RollupStore()
+        self.rankings = RankingIndex()
+        self.cube = TagCube()
+        self.cold = SegmentStore()
+        # Версия данных растет при каждом изменении товаров (ключ кэша графиков)
+        self.version = 0
+        self.events = EventLog(self.cold)
+        self.alerts = AlertManager()
         self.load_data()
+        self.events.open(self._snapshot_state)
+        self.cold.collect_garbage(self.events.segment_files)
+        today = datetime.now().strftime("%Y-%m-%d")
+        # Без файла агрегатов архивные дни иначе пропали бы из статистики
+        if self.rollups.frozen_until is None and self.cold.segments:
+            self.rollups.restore(self._segment_cells())
+        # Догоняем заморозку за дни, пока бот был выключен
+        self.freeze_rollups(today)
+        self.seal_cold_months(today)
+        self.rankings.rebuild(self.products)
+        self._rebuild_day_totals()
+        self._rebuild_cube()
     
     def load_data(self):
         """Загрузка данных из JSON файла"""
@@ -31,6 +838,13 @@ class ProductManager:
         except Exception as e:
             logger.error(f"Ошибка загрузки данных: {e}")
             self.products = []
+        
+        # Постоянный uid нужен журналу: ID товаров пересчитываются при удалении
+        missing_uid = [p for p in self.products if 'uid' not in p]
+        for product in missing_uid:
+            product['uid'] = uuid.uuid4().hex
+        if missing_uid:
+            self.save_data()
     
     def save_data(self):
         """Сохранение данных в JSON файла"""
@@ -39,13 +853,148 @@ class ProductManager:
                 json.dump(self.products, f, ensure_ascii=False, indent=2)
         except Exception as e:
             logger.error(f"Ошибка сохранения данных: {e}")
+        
+        if self.rollups.dirty:
+            self.rollups.save_data()
+    
+    def _snapshot_state(self):
+        """Состояние для снимка журнала: горячие товары и ссылки на сегменты"""
+        return {'products': self.products, 'segments': self.cold.refs()}
+    
+    def _index_add(self, product, month=None):
+        """Учет товара в поддерживаемых агрегатах"""
+        self.version += 1
+        self.rollups.apply(product, 1)
+        self.cube.apply(product, 1)
+        # Рейтинги архивного сегмента пересчитываются при записи его новой версии
+        if month is None:
+            self.rankings.add(product)
+            add_to_totals(self.day_totals.setdefault(product['date'], empty_totals()), product)
+    
+    def _index_remove(self, product, month=None):
+        """Исключение товара из поддерживаемых агрегатов"""
+        self.version += 1
+        self.rollups.apply(product, -1)
+        self.cube.apply(product, -1)
+        if month is None:
+            self.rankings.remove(product)
+            day_totals = self.day_totals[product['date']]
+            add_to_totals(day_totals, product, -1)
+            if day_totals['count'] == 0:
+                del self.day_totals[product['date']]
+    
+    def _rebuild_day_totals(self):
+        # Поддерживаемые агрегаты по дням для горячих товаров
+        self.day_totals = {}
+        for product in self.products:
+            add_to_totals(self.day_totals.setdefault(product['date'], empty_totals()), product)
+    
+    def _segment_cells(self):
+        # Архив берем из агрегатов сегментов, сегменты без куба пересчитываем
+        return [
+            meta['cube'] if 'cube' in meta else tag_cells(self.cold.load(meta['month']))
+            for meta in self.cold.segments
+        ]
+    
+    def _rebuild_cube(self):
+        cells = self._segment_cells()
+        cells.append(tag_cells(self.products))
+        self.cube.rebuild(cells)
     
-    def add_product(self, name, cost, expenses, final_price):
+    def get_day_totals(self, date):
+        """Агрегаты дня: горячие поддерживаются на лету, архивные заморожены"""
+        if date in self.day_totals:
+            return self.day_totals[date]
+        return self.rollups.daily.get(date, empty_totals())
+    
+    def _check_alerts(self, product):
+        self.alerts.evaluate(product, self.get_day_totals(product['date']))
+    
+    def _iter_live(self):
+        """Товары за еще не замороженные дни (с конца списка)"""
+        for product in reversed(self.products):
+            if self.rollups.is_frozen(product['date']):
+                break
+            yield product
+    
+    def freeze_rollups(self, until_date):
+        """Заморозка агрегатов по завершившимся дням"""
+        return self.rollups.freeze(self.products, until_date)
+    
+    def seal_cold_months(self, today):
+        """Перенос месяцев старше прошлого в архивные сегменты"""
+        month_start = datetime.strptime(today[:7] + '-01', '%Y-%m-%d')
+        previous_month = (month_start - timedelta(days=1)).strftime('%Y-%m')
+        split = bisect_left(self.products, previous_month, key=lambda p: p['date'][:7])
+        if split == 0:
+            return []
+        
+        by_month = defaultdict(list)
+        for product in self.products[:split]:
+            by_month[product['date'][:7]].append(product)
+        
+        for month, products in by_month.items():
+            if month in self.cold:
+                products = sorted(self.cold.load(month) + products, key=lambda p: p['date'])
+            self.cold.write(month, products)
+        self.cold.collect_garbage(self.events.segment_files)
+        
+        self.products = self.products[split:]
+        self._renumber()
+        self.save_data()
+        self.rankings.rebuild(self.products)
+        self._rebuild_day_totals()
+        logger.info(f"🧊 В архив перенесены месяцы: {', '.join(by_month)}")
+        return list(by_month)
+    
+    def _locate(self, product_id):
+        """Где лежит товар: (список, индекс в нем, месяц сегмента или None для горячих)"""
+        position = product_id - 1
+        if position < 0:
+            return None
+        
+        if position < self.cold.total_count:
+            month, idx = self.cold.locate(position)
+            return self.cold.load(month), idx, month
+        
+        idx = position - self.cold.total_count
+        if idx < len(self.products):
+            return self.products, idx, None
+        return None
+    
+    def _save_container(self, month):
+        """Сохранение списка, где менялся товар (новая версия сегмента или горячие товары)"""
+        if month is not None:
+            self.cold.write(month, self.cold.load(month))
+            # Прежняя версия нужна, только если на нее ссылается снимок журнала
+            self.cold.collect_garbage(self.events.segment_files)
+        self._renumber()
+        self.save_data()
+    
+    def _find_by_uid(self, uid, date=None):
+        for product in self.products:
+            if product.get('uid') == uid:
+                return product
+        
+        if date and date[:7] in self.cold:
+            for product in self.cold.load(date[:7]):
+                if product.get('uid') == uid:
+                    return product
+        return None
+    
+    def _renumber(self):
+        # ID сквозные: горячие товары идут после всех архивных
+        for i, product in enumerate(self.products, self.cold.total_count + 1):
+            product['id'] = i
+    
+    def add_product(self, name, cost, expenses, final_price, tag='', user_id=None):
         """Добавление нового товара"""
         profit = final_price - cost - expenses
         product = {
-            'id': len(self.products) + 1,
+            'id': self.get_total_count() + 1,
+            'uid': uuid.uuid4().hex,
             'name': name,
+            'tag': tag,
             'cost': float(cost),
             'expenses': float(expenses),
             'final_price': float(final_price),
@@ -54,118 +1003,592 @@ class ProductManager:
             'date': datetime.now().strftime("%Y-%m-%d")
         }
         self.products.append(product)
+        self._index_add(product)
         self.save_data()
+        self.events.record(
+            'add', user_id, self._snapshot_state,
+            uid=product['uid'], index=product['id'] - 1, product=dict(product)
+        )
+        self._check_alerts(product)
         return product
     
-    def get_all_products(self):
-        """Получение всех товаров"""
-        return self.products
+    def get_total_count(self):
+        """Количество всех товаров, включая архив"""
+        return self.cold.total_count + len(self.products)
+    
+    def _slice(self, start_idx, end_idx):
+        """Товары по сквозным позициям, архивные сегменты подгружаются по требованию"""
+        result = []
+        cold_count = self.cold.total_count
+        position = start_idx
+        while position < min(end_idx, cold_count):
+            month, idx = self.cold.locate(position)
+            chunk = self.cold.load(month)[idx:idx + end_idx - position]
+            result.extend(chunk)
+            position += len(chunk)
+        
+        if end_idx > cold_count:
+            result.extend(self.products[max(start_idx - cold_count, 0):end_idx - cold_count])
+        return result
     
     def get_products_page(self, page=1, page_size=10):
         """Получение товаров с пагинацией"""
         start_idx = (page - 1) * page_size
         end_idx = start_idx + page_size
-        total_count = len(self.products)
-        return self.products[start_idx:end_idx], total_count
+        return self._slice(start_idx, end_idx), self.get_total_count()
+    
+    def get_recent_products(self, count):
+        """Последние добавленные товары"""
+        total_count = self.get_total_count()
+        return self._slice(max(total_count - count, 0), total_count)
+    
+    def get_products_by_date(self, date):
+        """Товары за конкретную дату (списки отсортированы по дате)"""
+        products = self.cold.load(date[:7]) if date[:7] in self.cold else self.products
+        start_idx = bisect_left(products, date, key=lambda p: p['date'])
+        end_idx = bisect_right(products, date, key=lambda p: p['date'])
+        return products[start_idx:end_idx]
+    
+    def get_tag_statistics(self, start_date=None, end_date=None):
+        """Агрегаты по тегам за все время или за диапазон дат"""
+        return self.cube.group_by_tag(start_date, end_date)
+    
+    def get_tag_by_date(self, tag, start_date=None, end_date=None):
+        """Агрегаты тега по дням"""
+        return self.cube.drill_down(tag, start_date, end_date)
+    
+    def get_tags(self):
+        """Используемые теги, самые частые первыми"""
+        return self.cube.tags()
+    
+    def get_top_products(self, ranking, n=10, start_date=None, end_date=None):
+        """Топ-N товаров по рейтингу за все время или за диапазон дат (n не больше SEGMENT_TOP_K)"""
+        candidates = [
+            (ranking_key(ranking, product), product)
+            for product in self.rankings.top(ranking, n, start_date, end_date)
+        ]
+        
+        for meta in self.cold.segments:
+            month = meta['month']
+            if start_date is None:
+                # За все время хватает лучших товаров из агрегатов сегмента
+                offset = self.cold.offset(month)
+                candidates.extend(
+                    (key, {**product, 'id': offset + idx + 1})
+                    for key, idx, product in meta['top'][ranking][:n]
+                )
+            elif start_date[:7] <= month <= end_date[:7]:
+                candidates.extend(
+                    (ranking_key(ranking, product), product)
+                    for product in self.cold.load(month)
+                    if start_date <= product['date'] <= end_date
+                )
+        
+        return [product for _, product in heapq.nsmallest(n, candidates, key=lambda c: c[0])]
     
     def get_product(self, product_id):
         """Получение товара по ID"""
-        for product in self.products:
-            if product['id'] == product_id:
-                return product
-        return None
+        located = self._locate(product_id)
+        if not located:
+            return None
+        products, idx, _ = located
+        return products[idx]
     
-    def update_product_field(self, product_id, field, value):
+    def update_product_field(self, product_id, field, value, user_id=None, undo_of=None):
         """Обновление конкретного поля товара"""
-        for product in self.products:
-            if product['id'] == product_id:
-                if field == 'cost':
-                    product['cost'] = float(value)
-                elif field == 'expenses':
-                    product['expenses'] = float(value)
-                elif field == 'final_price':
-                    product['final_price'] = float(value)
-                elif field == 'name':
-                    product['name'] = value
-                
-                # Пересчитываем прибыль при изменении числовых полей
-                if field in ['cost', 'expenses', 'final_price']:
-                    product['profit'] = product['final_price'] - product['cost'] - product['expenses']
-                
-                product['updated_at'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                self.save_data()
-                return product
-        return None
+        located = self._locate(product_id)
+        if not located:
+            return None
+        
+        products, idx, month = located
+        product = products[idx]
+        # У товаров, добавленных до появления тегов, поля tag нет
+        old_value = product.get(field, '')
+        self._index_remove(product, month)
+        apply_field_update(product, field, value)
+        product['updated_at'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self._index_add(product, month)
+        self._save_container(month)
+        self.events.record(
+            'update', user_id, self._snapshot_state, undo_of,
+            uid=product['uid'], date=product['date'], name=product['name'],
+            field=field, old=old_value, new=product[field]
+        )
+        self._check_alerts(product)
+        return product
     
-    def delete_product(self, product_id):
+    def delete_product(self, product_id, user_id=None, undo_of=None):
         """Удаление товара"""
-        product_to_delete = None
-        for product in self.products:
-            if product['id'] == product_id:
-                product_to_delete = product
-                break
+        located = self._locate(product_id)
+        if not located:
+            return False
         
-        if product_to_delete:
-            self.products.remove(product_to_delete)
-            # Пересчитываем ID
-            for i, product in enumerate(self.products, 1):
-                product['id'] = i
-            self.save_data()
-            return True
-        return False
+        products, idx, month = located
+        product_to_delete = products.pop(idx)
+        self._index_remove(product_to_delete, month)
+        # Пересчитываем ID
+        self._save_container(month)
+        self.events.record(
+            'delete', user_id, self._snapshot_state, undo_of,
+            uid=product_to_delete['uid'], index=product_id - 1, product=dict(product_to_delete)
+        )
+        # Удаление может снять дневное оповещение; сам товар убыток больше не дает
+        self._check_alerts({**product_to_delete, 'profit': 0})
+        return True
+    
+    def restore_product(self, product, index, user_id=None, undo_of=None):
+        """Возврат удаленного товара на прежнее место"""
+        product = dict(product)
+        month = product['date'][:7]
+        
+        if month in self.cold:
+            products = self.cold.load(month)
+            offset = self.cold.offset(month)
+        else:
+            month = None
+            products = self.products
+            offset = self.cold.total_count
+        
+        insert_product(products, product, index - offset)
+        self._index_add(product, month)
+        self._save_container(month)
+        self.events.record(
+            'restore', user_id, self._snapshot_state, undo_of,
+            uid=product['uid'], index=product['id'] - 1, product=dict(product)
+        )
+        self._check_alerts(product)
+        return product
+    
+    def undo_last_change(self, user_id):
+        """Отмена последнего изменения пользователя: (событие, удалось ли отменить)"""
+        event = self.events.last_change(user_id)
+        if event is None:
+            return None, False
+        
+        date = event['product']['date'] if 'product' in event else event.get('date')
+        product = self._find_by_uid(event['uid'], date)
+        if event['type'] == 'add' and product:
+            self.delete_product(product['id'], user_id, undo_of=event['seq'])
+        elif event['type'] == 'update' and product and product.get(event['field'], '') == event['new']:
+            # Поле с тех пор не меняли - иначе откат затер бы чужую правку
+            self.update_product_field(product['id'], event['field'], event['old'], user_id, undo_of=event['seq'])
+        elif event['type'] == 'delete' and not product:
+            self.restore_product(event['product'], event['index'], user_id, undo_of=event['seq'])
+        else:
+            # Товар уже изменили другим действием - отменять нечего
+            self.events.record('undo_skipped', user_id, self._snapshot_state, event['seq'], uid=event['uid'])
+            return event, False
+        
+        return event, True
+    
+    def get_statistics_as_of(self, date):
+        """Общая статистика и статистика по датам на конец указанного дня"""
+        products = self.events.state_as_of(f"{date} 23:59:59")
+        if not products:
+            return None, None
+        
+        totals = empty_totals()
+        stats_by_date = {}
+        for product in products:
+            add_to_totals(totals, product)
+            add_to_totals(stats_by_date.setdefault(product['date'], empty_totals()), product)
+        
+        stats = {
+            'total_products': totals['count'],
+            'total_cost': totals['total_cost'],
+            'total_expenses': totals['total_expenses'],
+            'total_final': totals['total_final'],
+            'total_profit': totals['total_profit']
+        }
+        return stats, stats_by_date
     
     def get_statistics(self):
         """Получение общей статистики"""
-        if not self.products:
-            return None
+        # Завершившиеся дни берем из замороженных агрегатов, живьем считаем только свежие
+        totals = self.rollups.get_totals()
+        for product in self._iter_live():
+            add_to_totals(totals, product)
         
-        total_products = len(self.products)
-        total_cost = sum(p['cost'] for p in self.products)
-        total_expenses = sum(p['expenses'] for p in self.products)
-        total_final = sum(p['final_price'] for p in self.products)
-        total_profit = sum(p['profit'] for p in self.products)
+        if not totals['count']:
+            return None
         
         return {
-            'total_products': total_products,
-            'total_cost': total_cost,
-            'total_expenses': total_expenses,
-            'total_final': total_final,
-            'total_profit': total_profit
+            'total_products': totals['count'],
+            'total_cost': totals['total_cost'],
+            'total_expenses': totals['total_expenses'],
+            'total_final': totals['total_final'],
+            'total_profit': totals['total_profit']
         }
     
     def get_statistics_by_date(self, target_date=None):
-        """Получение статистики по датам"""
-        if not self.products:
-            return None
+        """Получение статистики по датам (товары дня - только для target_date)"""
+        if target_date:
+            products = self.get_products_by_date(target_date)
+            if not products:
+                return None
+            
+            if target_date in self.rollups.daily:
+                stats = dict(self.rollups.daily[target_date])
+            else:
+                stats = empty_totals()
+                for product in products:
+                    add_to_totals(stats, product)
+            
+            stats['products'] = products
+            return {target_date: stats}
         
-        stats_by_date = defaultdict(lambda: {
-            'count': 0,
-            'total_cost': 0,
-            'total_expenses': 0,
-            'total_final': 0,
-            'total_profit': 0,
-            'products': []
-        })
+        result = {date: dict(totals) for date, totals in self.rollups.daily.items()}
+        for product in self._iter_live():
+            add_to_totals(result.setdefault(product['date'], empty_totals()), product)
         
-        for product in self.products:
-            date = product['date']
-            stats_by_date[date]['count'] += 1
-            stats_by_date[date]['total_cost'] += product['cost']
-            stats_by_date[date]['total_expenses'] += product['expenses']
-            stats_by_date[date]['total_final'] += product['final_price']
-            stats_by_date[date]['total_profit'] += product['profit']
-            stats_by_date[date]['products'].append(product)
+        return result or None
+
+# Менеджеры с данными создаются в load_managers(), а не при импорте:
+# процессы пула графиков заново импортируют этот модуль
+product_manager = None
+
+# Лимит длины текста сообщения в Telegram
+MAX_MESSAGE_LENGTH = 4096
+
+# Приоритеты исходящих сообщений (меньше - важнее)
+class Priority:
+    HIGH = 0
+    NORMAL = 5
+    LOW = 10
+
+class TokenBucket:
+    """Ведро токенов для ограничения частоты отправки"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+    
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self, now):
+        """Сколько секунд осталось ждать до свободного токена"""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+    
+    def consume(self):
+        """Списание одного токена"""
+        self.tokens -= 1
+    
+    def pause(self, seconds, now):
+        """Пауза после ответа 429 от Telegram"""
+        self.paused_until = max(self.paused_until, now + seconds)
+    
+    def is_idle(self, now):
+        """Ведро полное и не на паузе - его можно забыть"""
+        self._refill(now)
+        return self.tokens >= self.capacity and self.paused_until <= now
+
+class OutboundMessage:
+    """Исходящее сообщение в очереди"""
+    def __init__(self, priority, seq, chat_id, method, kwargs, future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.futures = [future]
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.sealed = False
+    
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+    
+    def try_merge(self, method, priority, kwargs):
+        """Склейка со следующим сообщением в тот же чат"""
+        if self.sealed:
+            return False
+        
+        # Повторное редактирование того же сообщения заменяет еще не отправленное
+        if method == 'edit_message_text' and self.method == 'edit_message_text':
+            if kwargs.get('message_id') != self.kwargs.get('message_id'):
+                return False
+            # Приоритет не меняем: сообщение уже лежит в куче очереди
+            self.kwargs = kwargs
+            return True
         
-        result = dict(stats_by_date)
+        if method != 'send_message' or self.method != 'send_message':
+            return False
+        if priority != self.priority or kwargs.get('parse_mode') != self.kwargs.get('parse_mode'):
+            return False
         
-        # Если указана конкретная дата, возвращаем только ее
-        if target_date:
-            return {target_date: result[target_date]} if target_date in result else None
+        allowed = {'text', 'parse_mode', 'reply_markup'}
+        if set(kwargs) - allowed or set(self.kwargs) - allowed:
+            return False
         
-        return result
+        # Inline-клавиатура привязана к своему тексту, такие сообщения не склеиваем
+        old_markup = self.kwargs.get('reply_markup')
+        new_markup = kwargs.get('reply_markup')
+        if isinstance(old_markup, InlineKeyboardMarkup) or isinstance(new_markup, InlineKeyboardMarkup):
+            return False
+        
+        text = f"{self.kwargs['text']}\n\n{kwargs['text']}"
+        if len(text) > MAX_MESSAGE_LENGTH:
+            return False
+        
+        self.kwargs['text'] = text
+        if new_markup is not None:
+            self.kwargs['reply_markup'] = new_markup
+        return True
+
+class OutboundQueue:
+    """Очередь исходящих сообщений с ограничением частоты и повторами после 429"""
+    GLOBAL_RATE = 30
+    CHAT_RATE = 1
+    CHAT_BURST = 3
+    MAX_ATTEMPTS = 3
+    MAX_IDLE_BUCKETS = 1000
+    
+    def __init__(self):
+        self.bot = None
+        self._queue = asyncio.PriorityQueue()
+        self._worker = None
+        self._seq = itertools.count()
+        self._global_bucket = TokenBucket(self.GLOBAL_RATE, self.GLOBAL_RATE)
+        self._chat_buckets = {}
+        self._tails = {}  # последнее еще не отправленное сообщение каждого чата
+        self._blocked = set()  # чаты, у которых сообщение в отправке или в ожидании
+        self._parked = defaultdict(deque)
+        self._tasks = set()
+        self._pending = 0
+        self._latencies = deque(maxlen=500)
+        self.metrics = {
+            'max_queue_depth': 0,
+            'sent': 0,
+            'merged': 0,
+            'retries': 0,
+            'failed': 0
+        }
+    
+    def start(self, bot):
+        """Запуск фоновой отправки"""
+        self.bot = bot
+        self._worker = asyncio.create_task(self._run())
+    
+    async def stop(self, timeout=5):
+        """Остановка очереди с попыткой доотправить оставшиеся сообщения"""
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        
+        if self._pending:
+            logger.warning(f"Очередь остановлена, не отправлено сообщений: {self._pending}")
+        
+        tasks = list(self._tasks)
+        if self._worker:
+            tasks.append(self._worker)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker = None
+    
+    def enqueue(self, chat_id, method, priority=Priority.HIGH, **kwargs):
+        """Постановка вызова Bot API в очередь, возвращает future с результатом"""
+        future = asyncio.get_running_loop().create_future()
+        
+        tail = self._tails.get(chat_id)
+        if tail is not None and tail.try_merge(method, priority, kwargs):
+            tail.futures.append(future)
+            self.metrics['merged'] += 1
+            return future
+        
+        item = OutboundMessage(priority, next(self._seq), chat_id, method, kwargs, future)
+        self._tails[chat_id] = item
+        self._pending += 1
+        self.metrics['max_queue_depth'] = max(self.metrics['max_queue_depth'], self._pending)
+        self._queue.put_nowait(item)
+        return future
+    
+    def get_metrics(self):
+        """Метрики очереди: глубина и задержка отправки"""
+        latencies = sorted(self._latencies)
+        avg_latency = sum(latencies) / len(latencies) if latencies else 0
+        p95_latency = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0
+        
+        return {
+            'queue_depth': self._pending,
+            **self.metrics,
+            'latency_avg': avg_latency,
+            'latency_p95': p95_latency
+        }
+    
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.MAX_IDLE_BUCKETS:
+                now = time.monotonic()
+                for idle_chat in [c for c, b in self._chat_buckets.items() if c not in self._blocked and b.is_idle(now)]:
+                    del self._chat_buckets[idle_chat]
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.CHAT_RATE, self.CHAT_BURST)
+        return bucket
+    
+    def _hold(self, item, delay):
+        """Отложить сообщение, не пропуская вперед остальные сообщения того же чата"""
+        self._blocked.add(item.chat_id)
+        self._parked[item.chat_id].appendleft(item)
+        asyncio.get_running_loop().call_later(delay, self._release, item.chat_id)
+    
+    def _release(self, chat_id):
+        self._blocked.discard(chat_id)
+        for item in self._parked.pop(chat_id, ()):
+            self._queue.put_nowait(item)
+    
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            
+            if item.chat_id in self._blocked:
+                self._parked[item.chat_id].append(item)
+                continue
+            
+            while (delay := self._global_bucket.delay(time.monotonic())) > 0:
+                await asyncio.sleep(delay)
+            
+            bucket = self._chat_bucket(item.chat_id)
+            delay = bucket.delay(time.monotonic())
+            if delay > 0:
+                self._hold(item, delay)
+                continue
+            
+            self._global_bucket.consume()
+            bucket.consume()
+            
+            # После начала отправки к сообщению больше ничего не приклеиваем
+            item.sealed = True
+            if self._tails.get(item.chat_id) is item:
+                del self._tails[item.chat_id]
+            
+            self._blocked.add(item.chat_id)
+            task = asyncio.create_task(self._deliver(item))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def _deliver(self, item):
+        item.attempts += 1
+        try:
+            result = await getattr(self.bot, item.method)(chat_id=item.chat_id, **item.kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            logger.warning(f"Telegram просит подождать {retry_after} сек. (чат {item.chat_id})")
+            
+            # Флуд-лимит общий для бота, поэтому притормаживаем всю отправку
+            self._global_bucket.pause(retry_after, time.monotonic())
+            self.metrics['retries'] += 1
+            item.attempts -= 1
+            self._hold(item, retry_after)
+            return
+        except BadRequest as e:
+            # Нажатие на ту же страницу - текст не изменился, это не ошибка
+            if 'message is not modified' in str(e).lower():
+                self._complete(item, True)
+            else:
+                self._fail(item, e)
+        except NetworkError as e:
+            if item.attempts < self.MAX_ATTEMPTS:
+                logger.warning(f"Сетевая ошибка при отправке, повтор: {e}")
+                self.metrics['retries'] += 1
+                self._hold(item, 2 ** item.attempts)
+                return
+            self._fail(item, e)
+        except Exception as e:
+            self._fail(item, e)
+        else:
+            self._complete(item, result)
+        
+        self._release(item.chat_id)
+    
+    def _complete(self, item, result):
+        self._latencies.append(time.monotonic() - item.enqueued_at)
+        self.metrics['sent'] += 1
+        self._pending -= 1
+        for future in item.futures:
+            if not future.done():
+                future.set_result(result)
+    
+    def _fail(self, item, error):
+        logger.error(f"Ошибка отправки {item.method} в чат {item.chat_id}: {error}")
+        self.metrics['failed'] += 1
+        self._pending -= 1
+        for future in item.futures:
+            if not future.done():
+                future.set_exception(error)
+                # Ошибка уже залогирована, ответ обычно никто не ждет
+                future.exception()
+
+# Очередь исходящих сообщений
+outbound_queue = OutboundQueue()
+
+class SubscriptionManager:
+    """Чаты, подписанные на ежедневную сводку"""
+    def __init__(self, data_file='subscribers.json'):
+        self.data_file = data_file
+        self.load_data()
+    
+    def load_data(self):
+        """Загрузка подписчиков из JSON файла"""
+        try:
+            if os.path.exists(self.data_file):
+                with open(self.data_file, 'r', encoding='utf-8') as f:
+                    self.chat_ids = set(json.load(f))
+            else:
+                self.chat_ids = set()
+        except Exception as e:
+            logger.error(f"Ошибка загрузки подписчиков: {e}")
+            self.chat_ids = set()
+    
+    def save_data(self):
+        """Сохранение подписчиков в JSON файл"""
+        try:
+            with open(self.data_file, 'w', encoding='utf-8') as f:
+                json.dump(sorted(self.chat_ids), f)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения подписчиков: {e}")
+    
+    def subscribe(self, chat_id):
+        """Подписка чата на сводку"""
+        self.chat_ids.add(chat_id)
+        self.save_data()
+    
+    def unsubscribe(self, chat_id):
+        """Отписка чата от сводки"""
+        self.chat_ids.discard(chat_id)
+        self.save_data()
+
+subscription_manager = None
+
+def load_managers():
+    """Загрузка данных: создание менеджеров товаров и подписок"""
+    global product_manager, subscription_manager
+    product_manager = ProductManager()
+    subscription_manager = SubscriptionManager()
+
+async def reply(update: Update, text, priority=Priority.HIGH, **kwargs):
+    """Ответ в чат через очередь исходящих сообщений"""
+    return outbound_queue.enqueue(update.effective_chat.id, 'send_message', priority, text=text, **kwargs)
 
-# Создаем менеджер продуктов
-product_manager = ProductManager()
+async def reply_photo(update: Update, photo, priority=Priority.HIGH, **kwargs):
+    """Отправка картинки в чат через очередь исходящих сообщений"""
+    return outbound_queue.enqueue(update.effective_chat.id, 'send_photo', priority, photo=photo, **kwargs)
+
+async def edit(update: Update, text, priority=Priority.HIGH, **kwargs):
+    """Редактирование сообщения, под которым нажата inline-кнопка"""
+    message = update.callback_query.message
+    return outbound_queue.enqueue(
+        message.chat_id, 'edit_message_text', priority,
+        message_id=message.message_id, text=text, **kwargs
+    )
 
 # Состояния для диалога
 class States:
@@ -177,12 +1600,201 @@ class States:
     EDITING_SELECT_FIELD = 6
     EDITING_INPUT_VALUE = 7
     DELETING_SELECT_PRODUCT = 8
-    VIEWING_PRODUCTS_PAGE = 9
     SELECTING_DATE_FOR_STATS = 10
+    SELECTING_AS_OF_DATE = 11
+    DELETE_CONFIRMATION = 12
+    WAITING_TAG = 13
+
+# Размеры страниц при листании
+PAGE_SIZE = 10
+DATES_PAGE_SIZE = 10
 
 # Глобальные переменные для хранения временных данных
 user_sessions = {}
 
+# Завершение диалога: сессия пользователя удаляется
+END = -1
+
+class StateHandler:
+    """Обработчик состояния диалога с валидатором ввода и разрешенными переходами"""
+    def __init__(self, handler, validator, error, transitions):
+        self.handler = handler
+        self.validator = validator
+        self.error = error
+        self.transitions = frozenset(transitions) | {None}
+
+class DialogEngine:
+    """Табличный диспетчер диалога: кнопка или состояние -> обработчик за O(1)"""
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self._buttons = {}
+        self._states = {}
+        self._timing_hooks = []
+        self.timings = {}
+        self.add_timing_hook(self._record_timing)
+    
+    def button(self, *labels, transitions=()):
+        """Регистрация обработчика кнопок меню (работает в любом состоянии):
+        handler(update, context) возвращает начальное состояние диалога из transitions, END или None"""
+        def decorator(handler):
+            entry = StateHandler(handler, None, None, [END, *transitions])
+            for label in labels:
+                self._buttons[label] = entry
+            return handler
+        return decorator
+    
+    def state(self, state, validator=None, error=None, transitions=()):
+        """Регистрация обработчика состояния: handler(update, context, session, value)"""
+        def decorator(handler):
+            self._states[state] = StateHandler(handler, validator, error, transitions)
+            return handler
+        return decorator
+    
+    def add_timing_hook(self, hook):
+        """Хук hook(key, seconds) вызывается после обработки каждого сообщения"""
+        self._timing_hooks.append(hook)
+    
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка входящего текста"""
+        user_id = update.message.from_user.id
+        text = update.message.text
+        started = time.perf_counter()
+        # Время учитывается для каждого сообщения, в том числе отклоненного валидатором
+        key = 'fallback'
+        try:
+            button = self._buttons.get(text)
+            if button is not None:
+                key = f'button:{text}'
+                next_state = await button.handler(update, context)
+                self._apply(user_id, None, next_state, button.transitions)
+                return
+            
+            session = self.sessions.get(user_id)
+            entry = self._states.get(session['state']) if session else None
+            if entry is None:
+                await reply(update, "🤖 Используйте кнопки меню для навигации", parse_mode='Markdown')
+                return
+            
+            key = f'state:{STATE_NAMES.get(session["state"], session["state"])}'
+            value = text
+            if entry.validator is not None:
+                try:
+                    value = entry.validator(text)
+                except ValueError:
+                    await reply(update, entry.error)
+                    return
+            
+            next_state = await entry.handler(update, context, session, value)
+            self._apply(user_id, session, next_state, entry.transitions)
+        finally:
+            elapsed = time.perf_counter() - started
+            for hook in self._timing_hooks:
+                hook(key, elapsed)
+    
+    def begin(self, user_id, state):
+        """Начало диалога: новая сессия пользователя в состоянии state"""
+        self.sessions[user_id] = {'state': state}
+    
+    def _apply(self, user_id, session, next_state, allowed):
+        if next_state not in allowed:
+            # Обработчик уже ответил и мог изменить данные, поэтому не падаем,
+            # а оставляем пользователя в прежнем состоянии
+            logger.error(f"Недопустимый переход в состояние {next_state}, состояние не изменено")
+            return
+        
+        if next_state == END:
+            self.sessions.pop(user_id, None)
+        elif next_state is not None:
+            if session is None:
+                self.begin(user_id, next_state)
+            else:
+                session['state'] = next_state
+    
+    def _record_timing(self, key, elapsed):
+        stats = self.timings.setdefault(key, {'count': 0, 'total': 0.0, 'max': 0.0})
+        stats['count'] += 1
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+
+# Имена состояний для метрик
+STATE_NAMES = {value: name for name, value in vars(States).items() if name.isupper()}
+
+dialog = DialogEngine(user_sessions)
+
+def parse_amount(text):
+    """Валидатор суммы"""
+    value = float(text)
+    # nan и inf навсегда испортили бы поддерживаемые агрегаты и порядок в кучах рейтингов
+    if not math.isfinite(value):
+        raise ValueError(text)
+    return value
+
+def parse_number(text):
+    """Валидатор ID товара или номера пункта меню"""
+    if not text.isdigit():
+        raise ValueError(text)
+    return int(text)
+
+# Теги попадают в callback_data и в Markdown-разметку
+MAX_TAG_LENGTH = 20
+NO_TAG = '➖ Без тега'
+# Telegram ограничивает callback_data 64 байтами (не символами)
+CALLBACK_DATA_LIMIT = 64
+
+def tag_callback(window, tag):
+    """callback_data детализации тега; None, если не помещается в лимит Telegram"""
+    data = f'tag:{window}:{tag}'
+    return data if len(data.encode('utf-8')) <= CALLBACK_DATA_LIMIT else None
+
+def parse_tag(text):
+    """Валидатор тега ('-' или кнопка «Без тега» - без тега)"""
+    text = text.strip()
+    if text in (NO_TAG, '-'):
+        return ''
+    if not text or len(text) > MAX_TAG_LENGTH or any(c in text for c in '*_`['):
+        raise ValueError(text)
+    # Кириллица и эмодзи занимают несколько байт: проверяем кнопки всех периодов
+    if any(tag_callback(window, text) is None for window in RANKING_WINDOWS):
+        raise ValueError(text)
+    return text
+
+def tag_title(tag):
+    """Подпись тега для отчетов"""
+    return tag or 'без тега'
+
+def parse_date(text):
+    """Валидатор даты ГГГГ-ММ-ДД"""
+    datetime.strptime(text, '%Y-%m-%d')
+    return text
+
+# Поля товара для редактирования: пункт меню -> поле
+EDIT_FIELDS = {
+    1: 'name',
+    2: 'cost',
+    3: 'expenses',
+    4: 'final_price',
+    5: 'tag'
+}
+
+FIELD_NAMES = {
+    'name': 'название',
+    'cost': 'стоимость',
+    'expenses': 'расходы',
+    'final_price': 'итоговую цену',
+    'tag': 'тег'
+}
+
+TAG_FORMAT_ERROR = (
+    f"❌ Тег - до {MAX_TAG_LENGTH} символов (эмодзи - меньше) без * _ ` [\n"
+    "Для товара без тега отправьте «-»"
+)
+
+DATE_FORMAT_ERROR = (
+    "❌ *Неверный формат даты!*\n\n"
+    "Введите дату в формате *ГГГГ-ММ-ДД*\n"
+    "Пример: *2024-01-15*"
+)
+
 def format_detailed_product_list(products):
     """Подробный список товаров в столбик"""
     if not products:
@@ -195,6 +1807,7 @@ def format_detailed_product_list(products):
         message += (
             f"🆔 *ID:* {product['id']}\n"
             f"📦 *Название:* {product['name']}\n"
+            f"🔖 *Тег:* {tag_title(product_tag(product))}\n"
             f"💰 *Стоимость:* {product['cost']:.0f}₽\n"
             f"💸 *Расходы:* {product['expenses']:.0f}₽\n"
             f"🏷️ *Итоговая цена:* {product['final_price']:.0f}₽\n"
@@ -214,15 +1827,18 @@ def format_products_page(products, page, total_pages, total_products):
     if not products:
         return "📭 *Список товаров пуст*"
     
-    return format_detailed_product_list(products)
+    message = format_detailed_product_list(products)
+    message += f"\n📄 *Страница {page} из {total_pages}* (всего {total_products})"
+    return message
 
-def format_statistics_table(stats):
+def format_statistics_table(stats, as_of=None):
     """Статистика в виде таблички для мобильных"""
     if not stats:
         return "📊 *Нет данных для статистики*"
     
+    title = f"ОБЩАЯ СТАТИСТИКА НА {as_of}" if as_of else "ОБЩАЯ СТАТИСТИКА"
     table = (
-        "📈 *ОБЩАЯ СТАТИСТИКА*\n"
+        f"📈 *{title}*\n"
         "┌────────────────┬──────────┐\n"
         f"│ 📦 Товаров     │ {stats['total_products']:>8} │\n"
         f"│ 💰 Стоимость   │ {stats['total_cost']:>8.0f}₽ │\n"
@@ -237,6 +1853,93 @@ def format_statistics_table(stats):
     
     return table
 
+# Окна для рейтингов
+RANKING_WINDOWS = {
+    'today': '📅 Сегодня',
+    'month': '🗓️ Месяц',
+    'all': '♾️ Все время'
+}
+
+def format_ranking(ranking, window, products):
+    """Рейтинг товаров"""
+    title = RANKINGS[ranking][0]
+    message = f"🏆 *{title.upper()}* · {RANKING_WINDOWS[window]}\n"
+    message += "═" * 35 + "\n\n"
+    
+    if not products:
+        return message + "📭 *Нет товаров за выбранный период*"
+    
+    for i, product in enumerate(products, 1):
+        message += (
+            f"{i}. 🆔{product['id']} {product['name'][:20]} ({product['date']})\n"
+            f"   🎯{product['profit']:.0f}₽ 💸{product['expenses']:.0f}₽ 📊{product_margin(product):.1f}%\n"
+        )
+    
+    return message
+
+def format_tag_statistics(groups, window):
+    """Статистика по тегам в виде таблички для мобильных"""
+    title = f"🔖 *СТАТИСТИКА ПО ТЕГАМ* · {RANKING_WINDOWS[window]}\n"
+    if not groups:
+        return title + "\n📭 *Нет товаров за выбранный период*"
+    
+    table = (
+        title +
+        "┌────────────┬─────┬──────────┬────────┐\n"
+        "│ Тег        │ Шт. │  Прибыль │  Рент. │\n"
+        "├────────────┼─────┼──────────┼────────┤\n"
+    )
+    
+    totals = empty_totals()
+    for tag, stats in sorted(groups.items(), key=lambda item: -item[1]['total_profit']):
+        merge_totals(totals, stats)
+        profitability = (stats['total_profit'] / stats['total_final'] * 100) if stats['total_final'] > 0 else 0
+        table += (
+            f"│ {tag_title(tag)[:10]:<10} │ {stats['count']:>3} │ "
+            f"{stats['total_profit']:>7.0f}₽ │ {profitability:>5.1f}% │\n"
+        )
+    
+    table += "└────────────┴─────┴──────────┴────────┘\n"
+    
+    profitability = (totals['total_profit'] / totals['total_final'] * 100) if totals['total_final'] > 0 else 0
+    table += (
+        f"📦 *Товаров:* {totals['count']} | 🎯 *Прибыль:* {totals['total_profit']:.0f}₽\n"
+        f"📊 *Рентабельность:* {profitability:.1f}%"
+    )
+    
+    return table
+
+def format_tag_drilldown(tag, window, rows):
+    """Детализация тега по дням"""
+    message = f"🔖 *ТЕГ: {tag_title(tag).upper()}* · {RANKING_WINDOWS[window]}\n"
+    message += "═" * 35 + "\n\n"
+    
+    if not rows:
+        return message + "📭 *Нет товаров за выбранный период*"
+    
+    totals = empty_totals()
+    for _, stats in rows:
+        merge_totals(totals, stats)
+    
+    for date, stats in rows[-10:]:
+        message += (
+            f"📅 *{date}*\n"
+            f"   📦 {stats['count']} тов. | "
+            f"💸 {stats['total_expenses']:.0f}₽ | "
+            f"🎯 {stats['total_profit']:.0f}₽\n"
+            f"   ───────────────────\n"
+        )
+    
+    profitability = (totals['total_profit'] / totals['total_final'] * 100) if totals['total_final'] > 0 else 0
+    message += (
+        f"\n📦 *Товаров:* {totals['count']} за {len(rows)} дн.\n"
+        f"🏷️ *Итог:* {totals['total_final']:.0f}₽\n"
+        f"🎯 *Прибыль:* {totals['total_profit']:.0f}₽\n"
+        f"📊 *Рентабельность:* {profitability:.1f}%"
+    )
+    
+    return message
+
 def format_date_statistics(stats_by_date, target_date=None):
     """Статистика по дате с детализацией товаров"""
     if not stats_by_date:
@@ -295,192 +1998,313 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         ['📦 Добавить товар', '📋 Список товаров'],
         ['📈 Общая статистика', '📅 Статистика по дате'],
-        ['✏️ Редактировать', '🗑️ Удалить товар']
+        ['✏️ Редактировать', '🗑️ Удалить товар'],
+        ['🏆 Рейтинги']
     ]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
     stats = product_manager.get_statistics()
     total_products = stats['total_products'] if stats else 0
     
-    await update.message.reply_text(
+    await reply(
+        update,
         f"🤖 *Управление товарами*\n"
         f"📊 Всего товаров: {total_products}\n\n"
         f"*Используйте кнопки для управления:*\n"
         f"• Добавить - новый товар\n"
         f"• Список - подробный просмотр\n"
         f"• Статистика - аналитика и отчеты\n"
+        f"• Рейтинги - лучшие и худшие товары\n"
         f"• Редактировать - изменить товар\n"
-        f"• Удалить - удалить товар",
+        f"• Удалить - удалить товар\n"
+        f"• /undo - отменить последнее изменение\n"
+        f"• /alerts - оповещения о прибыли и расходах\n"
+        f"• /chart - график прибыли по дням",
         reply_markup=reply_markup,
         parse_mode='Markdown'
     )
 
+@dialog.button('📦 Добавить товар', transitions=[States.WAITING_NAME])
 async def handle_add_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало добавления товара"""
-    user_id = update.message.from_user.id
-    user_sessions[user_id] = {'state': States.WAITING_NAME}
-    
     keyboard = [['🔙 Отмена']]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
-    await update.message.reply_text(
+    await reply(
+        update,
         "📝 *Добавление нового товара*\n\n"
         "Введите название товара:",
         reply_markup=reply_markup,
         parse_mode='Markdown'
     )
+    return States.WAITING_NAME
+
+def build_products_page(page):
+    """Страница списка товаров с inline-навигацией"""
+    total_count = product_manager.get_total_count()
+    total_pages = max(1, (total_count + PAGE_SIZE - 1) // PAGE_SIZE)
+    page = min(max(page, 1), total_pages)
+    products, total_count = product_manager.get_products_page(page, PAGE_SIZE)
+    
+    message = format_products_page(products, page, total_pages, total_count)
+    
+    # Номер страницы лежит прямо в callback_data, сессия для листания не нужна
+    buttons = []
+    if page > 1:
+        buttons.append(InlineKeyboardButton('⬅️ Назад', callback_data=f'list:{page - 1}'))
+    buttons.append(InlineKeyboardButton(f'{page}/{total_pages}', callback_data='noop'))
+    if page < total_pages:
+        buttons.append(InlineKeyboardButton('Вперед ➡️', callback_data=f'list:{page + 1}'))
+    
+    return message, InlineKeyboardMarkup([buttons])
+
+def build_general_statistics():
+    """Общая статистика с переходом к статистике по датам"""
+    stats = product_manager.get_statistics()
+    message = format_statistics_table(stats) if stats else "📊 *Нет данных для статистики*"
+    
+    keyboard = [
+        [InlineKeyboardButton('📅 Статистика по дате', callback_data='dates:1')],
+        [InlineKeyboardButton('🕰️ Статистика на дату', callback_data='asof')],
+        [InlineKeyboardButton('🔖 Статистика по тегам', callback_data='tags:all')]
+    ]
+    return message, InlineKeyboardMarkup(keyboard)
+
+def build_as_of_report(target_date):
+    """Общая статистика и последние даты в состоянии на конец указанного дня"""
+    stats, stats_by_date = product_manager.get_statistics_as_of(target_date)
+    if not stats:
+        return f"📊 *Нет данных на {target_date}*"
+    
+    message = format_statistics_table(stats, as_of=target_date)
+    message += "\n\n" + format_date_statistics(stats_by_date)
+    return message
+
+def build_dates_page(page):
+    """Страница доступных дат, первая страница - самые свежие"""
+    stats_by_date = product_manager.get_statistics_by_date()
+    if not stats_by_date:
+        return "📊 *Нет данных по датам*", None
+    
+    dates = sorted(stats_by_date.keys())
+    total_pages = (len(dates) + DATES_PAGE_SIZE - 1) // DATES_PAGE_SIZE
+    page = min(max(page, 1), total_pages)
+    end_idx = len(dates) - (page - 1) * DATES_PAGE_SIZE
+    start_idx = max(0, end_idx - DATES_PAGE_SIZE)
+    page_dates = dates[start_idx:end_idx]
+    
+    message = "📅 *ВЫБОР ДАТЫ ДЛЯ СТАТИСТИКИ*\n\n"
+    message += "*Доступные даты:*\n"
+    
+    for i, date in enumerate(page_dates, 1):
+        profit = stats_by_date[date]['total_profit']
+        message += f"{i}. {date} - {profit:.0f}₽\n"
+    
+    keyboard = [
+        [InlineKeyboardButton(date, callback_data=f'date:{date}') for date in page_dates[i:i + 2]]
+        for i in range(0, len(page_dates), 2)
+    ]
+    
+    navigation = []
+    if start_idx > 0:
+        navigation.append(InlineKeyboardButton('⬅️ Раньше', callback_data=f'dates:{page + 1}'))
+    if page > 1:
+        navigation.append(InlineKeyboardButton('Позже ➡️', callback_data=f'dates:{page - 1}'))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton('📈 Общая статистика', callback_data='stats')])
+    
+    return message, InlineKeyboardMarkup(keyboard)
 
-async def handle_list_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показать подробный список товаров"""
-    products, total_count = product_manager.get_products_page(1, 10)
-    total_pages = (total_count + 9) // 10
+def build_date_report(target_date):
+    """Отчет за дату с переходами к соседним датам"""
+    message = format_date_statistics(product_manager.get_statistics_by_date(target_date), target_date)
+    stats_by_date = product_manager.get_statistics_by_date()
     
-    if not products:
-        await update.message.reply_text("📭 *Список товаров пуст*", parse_mode='Markdown')
-        return
+    if not stats_by_date or target_date not in stats_by_date:
+        keyboard = [[InlineKeyboardButton('📅 К списку дат', callback_data='dates:1')]]
+        return message, InlineKeyboardMarkup(keyboard)
     
-    user_id = update.message.from_user.id
-    user_sessions[user_id] = {
-        'state': States.VIEWING_PRODUCTS_PAGE,
-        'page': 1,
-        'total_pages': total_pages
-    }
+    dates = sorted(stats_by_date.keys())
+    idx = dates.index(target_date)
     
-    message = format_products_page(products, 1, total_pages, total_count)
+    navigation = []
+    if idx > 0:
+        navigation.append(InlineKeyboardButton(f'⬅️ {dates[idx - 1]}', callback_data=f'date:{dates[idx - 1]}'))
+    if idx < len(dates) - 1:
+        navigation.append(InlineKeyboardButton(f'{dates[idx + 1]} ➡️', callback_data=f'date:{dates[idx + 1]}'))
     
-    # Клавиатура для навигации
-    keyboard = []
-    if total_pages > 1:
-        keyboard.append(['➡️ Следующая страница'])
-    keyboard.append(['🔙 Главное меню'])
+    dates_page = (len(dates) - 1 - idx) // DATES_PAGE_SIZE + 1
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton('📅 К списку дат', callback_data=f'dates:{dates_page}')])
     
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    return message, InlineKeyboardMarkup(keyboard)
+
+def window_dates(window):
+    """Диапазон дат окна отчета: (начало, конец) или (None, None) для всего времени"""
+    if window not in RANKING_WINDOWS:
+        raise ValueError(f"Неизвестный период: {window}")
     
-    await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+    today = datetime.now().strftime("%Y-%m-%d")
+    if window == 'today':
+        return today, today
+    if window == 'month':
+        return today[:7] + '-01', today
+    return None, None
 
-async def handle_next_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Следующая страница товаров"""
-    user_id = update.message.from_user.id
+def build_ranking_report(ranking, window):
+    """Рейтинг с переключением типа и периода"""
+    if ranking not in RANKINGS:
+        raise ValueError(f"Неизвестный рейтинг: {ranking}")
     
-    if user_id in user_sessions and user_sessions[user_id]['state'] == States.VIEWING_PRODUCTS_PAGE:
-        session = user_sessions[user_id]
-        current_page = session['page']
-        total_pages = session['total_pages']
-        
-        if current_page < total_pages:
-            next_page = current_page + 1
-            products, total_count = product_manager.get_products_page(next_page, 10)
-            
-            user_sessions[user_id]['page'] = next_page
-            
-            message = format_products_page(products, next_page, total_pages, total_count)
-            
-            # Клавиатура для навигации
-            keyboard = []
-            if next_page > 1:
-                keyboard.append(['⬅️ Предыдущая страница'])
-            if next_page < total_pages:
-                keyboard.append(['➡️ Следующая страница'])
-            keyboard.append(['🔙 Главное меню'])
-            
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            
-            await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
-        else:
-            await update.message.reply_text("📄 *Это последняя страница*", parse_mode='Markdown')
-    else:
-        await handle_list_products(update, context)
+    products = product_manager.get_top_products(ranking, 10, *window_dates(window))
+    
+    message = format_ranking(ranking, window, products)
+    
+    ranking_buttons = [
+        InlineKeyboardButton(('• ' if name == ranking else '') + RANKINGS[name][0], callback_data=f'top:{name}:{window}')
+        for name in RANKINGS
+    ]
+    window_buttons = [
+        InlineKeyboardButton(('• ' if name == window else '') + title, callback_data=f'top:{ranking}:{name}')
+        for name, title in RANKING_WINDOWS.items()
+    ]
+    keyboard = [ranking_buttons[:2], ranking_buttons[2:], window_buttons]
+    
+    return message, InlineKeyboardMarkup(keyboard)
 
-async def handle_prev_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Предыдущая страница товаров"""
-    user_id = update.message.from_user.id
+def build_tag_statistics(window):
+    """Статистика по тегам с переключением периода и переходом к тегу"""
+    groups = product_manager.get_tag_statistics(*window_dates(window))
+    message = format_tag_statistics(groups, window)
     
-    if user_id in user_sessions and user_sessions[user_id]['state'] == States.VIEWING_PRODUCTS_PAGE:
-        session = user_sessions[user_id]
-        current_page = session['page']
-        
-        if current_page > 1:
-            prev_page = current_page - 1
-            products, total_count = product_manager.get_products_page(prev_page, 10)
-            
-            user_sessions[user_id]['page'] = prev_page
-            
-            message = format_products_page(products, prev_page, session['total_pages'], total_count)
-            
-            # Клавиатура для навигации
-            keyboard = []
-            if prev_page > 1:
-                keyboard.append(['⬅️ Предыдущая страница'])
-            if prev_page < session['total_pages']:
-                keyboard.append(['➡️ Следующая страница'])
-            keyboard.append(['🔙 Главное меню'])
-            
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            
-            await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
-        else:
-            await update.message.reply_text("📄 *Это первая страница*", parse_mode='Markdown')
-    else:
-        await handle_list_products(update, context)
+    window_buttons = [
+        InlineKeyboardButton(('• ' if name == window else '') + title, callback_data=f'tags:{name}')
+        for name, title in RANKING_WINDOWS.items()
+    ]
+    # Кнопки первых 8 тегов по прибыли, тег - последняя часть callback_data;
+    # старые теги длиннее лимита кнопок не получают, иначе Telegram отвергнет всю клавиатуру
+    tags = sorted(groups, key=lambda tag: -groups[tag]['total_profit'])
+    tags = [tag for tag in tags if tag_callback(window, tag)][:8]
+    tag_buttons = [
+        InlineKeyboardButton(f'🔖 {tag_title(tag)}', callback_data=tag_callback(window, tag))
+        for tag in tags
+    ]
+    keyboard = [window_buttons]
+    keyboard.extend(tag_buttons[i:i + 2] for i in range(0, len(tag_buttons), 2))
+    keyboard.append([InlineKeyboardButton('📈 Общая статистика', callback_data='stats')])
+    
+    return message, InlineKeyboardMarkup(keyboard)
 
-async def handle_general_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показать общую статистику в виде таблички"""
-    stats = product_manager.get_statistics()
-    message = format_statistics_table(stats) if stats else "📊 *Нет данных для статистики*"
+def build_tag_report(window, tag):
+    """Детализация тега по дням с переключением периода"""
+    rows = product_manager.get_tag_by_date(tag, *window_dates(window))
+    message = format_tag_drilldown(tag, window, rows)
     
+    window_buttons = [
+        InlineKeyboardButton(('• ' if name == window else '') + title, callback_data=tag_callback(name, tag))
+        for name, title in RANKING_WINDOWS.items()
+        if tag_callback(name, tag)
+    ]
     keyboard = [
-        ['📅 Статистика по дате'],
-        ['🔙 Главное меню']
+        window_buttons,
+        [InlineKeyboardButton('🔖 Все теги', callback_data=f'tags:{window}')]
     ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
-    await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+    return message, InlineKeyboardMarkup(keyboard)
+
+@dialog.button('📋 Список товаров')
+async def handle_list_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать подробный список товаров"""
+    if not product_manager.get_total_count():
+        await reply(update, "📭 *Список товаров пуст*", parse_mode='Markdown')
+        return
+    
+    message, reply_markup = build_products_page(1)
+    await reply(update, message, reply_markup=reply_markup, parse_mode='Markdown')
+
+@dialog.button('📈 Общая статистика')
+async def handle_general_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать общую статистику в виде таблички"""
+    message, reply_markup = build_general_statistics()
+    await reply(update, message, reply_markup=reply_markup, parse_mode='Markdown')
 
+@dialog.button('🏆 Рейтинги')
+async def handle_rankings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Рейтинги товаров"""
+    message, reply_markup = build_ranking_report('top_profit', 'all')
+    await reply(update, message, reply_markup=reply_markup, parse_mode='Markdown')
+
+@dialog.button('📅 Статистика по дате', transitions=[States.SELECTING_DATE_FOR_STATS])
 async def handle_date_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Меню статистики по дате"""
-    stats_by_date = product_manager.get_statistics_by_date()
+    message, reply_markup = build_dates_page(1)
     
-    if not stats_by_date:
-        await update.message.reply_text("📊 *Нет данных по датам*", parse_mode='Markdown')
+    if reply_markup is None:
+        await reply(update, message, parse_mode='Markdown')
         return
     
-    # Показываем доступные даты
-    available_dates = sorted(stats_by_date.keys())[-10:]  # Последние 10 дат
-    
-    message = "📅 *ВЫБОР ДАТЫ ДЛЯ СТАТИСТИКИ*\n\n"
-    message += "*Доступные даты:*\n"
-    
-    for i, date in enumerate(available_dates, 1):
-        profit = stats_by_date[date]['total_profit']
-        message += f"{i}. {date} - {profit:.0f}₽\n"
-    
-    message += "\n*Введите дату в формате ГГГГ-ММ-ДД*\n"
+    message += "\n*Выберите дату или введите ее в формате ГГГГ-ММ-ДД*\n"
     message += "Пример: 2024-01-15"
     
-    user_id = update.message.from_user.id
-    user_sessions[user_id] = {'state': States.SELECTING_DATE_FOR_STATS}
+    await reply(update, message, reply_markup=reply_markup, parse_mode='Markdown')
+    return States.SELECTING_DATE_FOR_STATS
+
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик нажатий inline-кнопок: редактирует исходное сообщение"""
+    query = update.callback_query
+    await query.answer()
     
-    keyboard = [['🔙 Главное меню']]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    action, _, arg = query.data.partition(':')
+    
+    try:
+        if action == 'list':
+            message, reply_markup = build_products_page(int(arg))
+        elif action == 'stats':
+            message, reply_markup = build_general_statistics()
+        elif action == 'dates':
+            message, reply_markup = build_dates_page(int(arg))
+        elif action == 'date':
+            message, reply_markup = build_date_report(arg)
+        elif action == 'asof':
+            dialog.begin(query.from_user.id, States.SELECTING_AS_OF_DATE)
+            message = (
+                "🕰️ *СТАТИСТИКА НА ДАТУ*\n\n"
+                "Покажу данные такими, какими они были в конце выбранного дня.\n\n"
+                "*Введите дату в формате ГГГГ-ММ-ДД*\n"
+                "Пример: 2024-01-15"
+            )
+            reply_markup = None
+        elif action == 'top':
+            ranking, _, window = arg.partition(':')
+            message, reply_markup = build_ranking_report(ranking, window)
+        elif action == 'tags':
+            message, reply_markup = build_tag_statistics(arg)
+        elif action == 'tag':
+            window, _, tag = arg.partition(':')
+            message, reply_markup = build_tag_report(window, tag)
+        else:
+            return
+    except ValueError:
+        logger.warning(f"Некорректные данные кнопки: {query.data}")
+        return
     
-    await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+    await edit(update, message, reply_markup=reply_markup, parse_mode='Markdown')
 
+@dialog.button('✏️ Редактировать', transitions=[States.EDITING_SELECT_PRODUCT])
 async def handle_edit_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало редактирования товара"""
-    products = product_manager.get_all_products()
+    products = product_manager.get_recent_products(15)
     
     if not products:
-        await update.message.reply_text("❌ *Нет товаров для редактирования*", parse_mode='Markdown')
+        await reply(update, "❌ *Нет товаров для редактирования*", parse_mode='Markdown')
         return
     
-    user_id = update.message.from_user.id
-    user_sessions[user_id] = {'state': States.EDITING_SELECT_PRODUCT}
-    
     # Показываем краткий список для выбора
     message = "✏️ *РЕДАКТИРОВАНИЕ ТОВАРА*\n\n"
     message += "*Доступные товары:*\n"
     
-    for product in products[-15:]:  # Последние 15 товаров
+    for product in products:  # Последние 15 товаров
         message += f"🆔{product['id']} - {product['name'][:20]} (+{product['profit']:.0f}₽)\n"
     
     message += "\n📝 *Введите ID товара для редактирования:*"
@@ -488,25 +2312,24 @@ async def handle_edit_product(update: Update, context: ContextTypes.DEFAULT_TYPE
     keyboard = [['🔙 Главное меню']]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
-    await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+    await reply(update, message, reply_markup=reply_markup, parse_mode='Markdown')
+    return States.EDITING_SELECT_PRODUCT
 
+@dialog.button('🗑️ Удалить товар', transitions=[States.DELETING_SELECT_PRODUCT])
 async def handle_delete_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало удаления товара"""
-    products = product_manager.get_all_products()
+    products = product_manager.get_recent_products(15)
     
     if not products:
-        await update.message.reply_text("❌ *Нет товаров для удаления*", parse_mode='Markdown')
+        await reply(update, "❌ *Нет товаров для удаления*", parse_mode='Markdown')
         return
     
-    user_id = update.message.from_user.id
-    user_sessions[user_id] = {'state': States.DELETING_SELECT_PRODUCT}
-    
     message = (
         "🗑️ *УДАЛЕНИЕ ТОВАРА*\n\n"
         "*Доступные товары:*\n"
     )
     
-    for product in products[-15:]:  # Последние 15 товаров
+    for product in products:  # Последние 15 товаров
         message += f"🆔{product['id']} - {product['name'][:20]} (+{product['profit']:.0f}₽)\n"
     
     message += "\n⚠️ *Введите ID товара для удаления:*"
@@ -514,20 +2337,22 @@ async def handle_delete_product(update: Update, context: ContextTypes.DEFAULT_TY
     keyboard = [['🔙 Главное меню']]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
-    await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+    await reply(update, message, reply_markup=reply_markup, parse_mode='Markdown')
+    return States.DELETING_SELECT_PRODUCT
 
 async def show_edit_fields_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id: int):
     """Показать меню выбора поля для редактирования"""
     product = product_manager.get_product(product_id)
     
     if not product:
-        await update.message.reply_text("❌ *Товар не найден*", parse_mode='Markdown')
+        await reply(update, "❌ *Товар не найден*", parse_mode='Markdown')
         return
     
     message = (
         f"✏️ *РЕДАКТИРОВАНИЕ ТОВАРА* 🆔{product_id}\n\n"
         f"🆔 *ID:* {product['id']}\n"
         f"📦 *Название:* {product['name']}\n"
+        f"🔖 *Тег:* {tag_title(product_tag(product))}\n"
         f"💰 *Стоимость:* {product['cost']:.0f}₽\n"
         f"💸 *Расходы:* {product['expenses']:.0f}₽\n"
         f"🏷️ *Итоговая цена:* {product['final_price']:.0f}₽\n"
@@ -538,316 +2363,571 @@ async def show_edit_fields_menu(update: Update, context: ContextTypes.DEFAULT_TY
         "2 💰 Стоимость\n" 
         "3 💸 Расходы\n"
         "4 🏷️ Итоговая цена\n"
+        "5 🔖 Тег\n"
         "0 ❌ Отмена"
     )
     
     keyboard = [['🔙 Главное меню']]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     
-    await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+    await reply(update, message, reply_markup=reply_markup, parse_mode='Markdown')
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик всех сообщений"""
-    user_id = update.message.from_user.id
-    text = update.message.text
+    await dialog.dispatch(update, context)
+
+@dialog.button('🔙 Главное меню', '🔙 Отмена')
+async def handle_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Возврат в главное меню с завершением текущего диалога"""
+    await start(update, context)
+    return END
+
+# Добавление товара
+@dialog.state(States.WAITING_NAME, transitions=[States.WAITING_COST])
+async def on_waiting_name(update, context, session, text):
+    session['name'] = text
     
-    # Основное меню
-    if text == '📦 Добавить товар':
-        await handle_add_product(update, context)
-        return
-    elif text == '📋 Список товаров':
-        await handle_list_products(update, context)
-        return
-    elif text == '➡️ Следующая страница':
-        await handle_next_page(update, context)
-        return
-    elif text == '⬅️ Предыдущая страница':
-        await handle_prev_page(update, context)
-        return
-    elif text == '📈 Общая статистика':
-        await handle_general_statistics(update, context)
-        return
-    elif text == '📅 Статистика по дате':
-        await handle_date_statistics(update, context)
-        return
-    elif text == '✏️ Редактировать':
-        await handle_edit_product(update, context)
-        return
-    elif text == '🗑️ Удалить товар':
-        await handle_delete_product(update, context)
-        return
-    elif text in ['🔙 Главное меню', '🔙 Отмена']:
+    keyboard = [['🔙 Отмена']]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    
+    await reply(update, "💰 Введите стоимость товара:", reply_markup=reply_markup, parse_mode='Markdown')
+    return States.WAITING_COST
+
+@dialog.state(
+    States.WAITING_COST, parse_amount, "❌ Введите корректное число для стоимости",
+    transitions=[States.WAITING_EXPENSES]
+)
+async def on_waiting_cost(update, context, session, cost):
+    session['cost'] = cost
+    
+    keyboard = [['🔙 Отмена']]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    
+    await reply(update, "💸 Введите расходы:", reply_markup=reply_markup, parse_mode='Markdown')
+    return States.WAITING_EXPENSES
+
+@dialog.state(
+    States.WAITING_EXPENSES, parse_amount, "❌ Введите корректное число для расходов",
+    transitions=[States.WAITING_FINAL_PRICE]
+)
+async def on_waiting_expenses(update, context, session, expenses):
+    session['expenses'] = expenses
+    
+    keyboard = [['🔙 Отмена']]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    
+    await reply(update, "🏷️ Введите итоговую цену:", reply_markup=reply_markup, parse_mode='Markdown')
+    return States.WAITING_FINAL_PRICE
+
+@dialog.state(
+    States.WAITING_FINAL_PRICE, parse_amount, "❌ Введите корректное число для итоговой цены",
+    transitions=[States.WAITING_TAG]
+)
+async def on_waiting_final_price(update, context, session, final_price):
+    session['final_price'] = final_price
+    
+    # Самые частые теги предлагаем кнопками, новый можно ввести текстом
+    tags = product_manager.get_tags()[:6]
+    keyboard = [tags[i:i + 2] for i in range(0, len(tags), 2)]
+    keyboard.append([NO_TAG, '🔙 Отмена'])
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    
+    await reply(
+        update,
+        "🔖 Выберите тег (поставщик, категория, канал продаж) или введите новый:",
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+    return States.WAITING_TAG
+
+@dialog.state(States.WAITING_TAG, parse_tag, TAG_FORMAT_ERROR, transitions=[END])
+async def on_waiting_tag(update, context, session, tag):
+    product = product_manager.add_product(
+        session['name'],
+        session['cost'],
+        session['expenses'],
+        session['final_price'],
+        tag=tag,
+        user_id=update.message.from_user.id
+    )
+    
+    # Показываем результат
+    message = (
+        "✅ *Товар успешно добавлен!*\n\n"
+        f"📦 Название: *{product['name']}*\n"
+        f"🔖 Тег: *{tag_title(tag)}*\n"
+        f"💰 Стоимость: *{product['cost']:.0f}₽*\n"
+        f"💸 Расходы: *{product['expenses']:.0f}₽*\n"
+        f"🏷️ Итоговая цена: *{product['final_price']:.0f}₽*\n"
+        f"🎯 Прибыль: *{product['profit']:.0f}₽*\n"
+        f"📅 Дата добавления: *{product['date']}*\n\n"
+        f"📈 Рентабельность: *{product_margin(product):.1f}%*"
+    )
+    
+    await reply(update, message, parse_mode='Markdown')
+    await start(update, context)
+    return END
+
+# Статистика по дате - ввод даты
+@dialog.state(States.SELECTING_DATE_FOR_STATS, parse_date, DATE_FORMAT_ERROR, transitions=[END])
+async def on_selecting_date_for_stats(update, context, session, date):
+    message, reply_markup = build_date_report(date)
+    await reply(update, message, reply_markup=reply_markup, parse_mode='Markdown')
+    return END
+
+# Статистика на дату - ввод даты
+@dialog.state(States.SELECTING_AS_OF_DATE, parse_date, DATE_FORMAT_ERROR, transitions=[END])
+async def on_selecting_as_of_date(update, context, session, date):
+    await reply(update, build_as_of_report(date), parse_mode='Markdown')
+    return END
+
+# Редактирование - выбор товара
+@dialog.state(
+    States.EDITING_SELECT_PRODUCT, parse_number, "❌ Введите корректный ID товара (число)",
+    transitions=[States.EDITING_SELECT_FIELD]
+)
+async def on_editing_select_product(update, context, session, product_id):
+    if not product_manager.get_product(product_id):
+        await reply(update, "❌ Товар с таким ID не найден")
+        return None
+    
+    session['product_id'] = product_id
+    await show_edit_fields_menu(update, context, product_id)
+    return States.EDITING_SELECT_FIELD
+
+# Редактирование - выбор поля
+@dialog.state(
+    States.EDITING_SELECT_FIELD, parse_number, "❌ Введите цифру от 1 до 5",
+    transitions=[States.EDITING_INPUT_VALUE, END]
+)
+async def on_editing_select_field(update, context, session, choice):
+    if choice == 0:
         await start(update, context)
-        return
+        return END
     
-    # Обработка состояний диалога
-    if user_id in user_sessions:
-        session = user_sessions[user_id]
-        state = session['state']
-        
-        # Добавление товара (остается без изменений)
-        if state == States.WAITING_NAME:
-            user_sessions[user_id]['name'] = text
-            user_sessions[user_id]['state'] = States.WAITING_COST
-            
-            keyboard = [['🔙 Отмена']]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-            
-            await update.message.reply_text(
-                "💰 Введите стоимость товара:",
-                reply_markup=reply_markup,
+    if choice not in EDIT_FIELDS:
+        await reply(update, "❌ Неверный выбор. Введите цифру от 1 до 5")
+        return None
+    
+    field = EDIT_FIELDS[choice]
+    session['field'] = field
+    
+    keyboard = [['🔙 Отмена']]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    
+    await reply(
+        update,
+        f"✏️ Введите новое значение для {FIELD_NAMES[field]}:",
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+    return States.EDITING_INPUT_VALUE
+
+# Редактирование - ввод значения
+@dialog.state(States.EDITING_INPUT_VALUE, transitions=[END])
+async def on_editing_input_value(update, context, session, text):
+    product_id = session['product_id']
+    field = session['field']
+    
+    # Валидация числовых полей
+    if field in ['cost', 'expenses', 'final_price']:
+        try:
+            value = parse_amount(text)
+        except ValueError:
+            await reply(update, "❌ Введите корректное числовое значение")
+            return None
+    elif field == 'tag':
+        try:
+            value = parse_tag(text)
+        except ValueError:
+            await reply(update, TAG_FORMAT_ERROR)
+            return None
+    else:
+        value = text
+    
+    updated_product = product_manager.update_product_field(
+        product_id, field, value, user_id=update.message.from_user.id
+    )
+    
+    if not updated_product:
+        await reply(update, "❌ Ошибка при обновлении товара")
+        return None
+    
+    message = (
+        f"✅ *{FIELD_NAMES[field].title()} успешно обновлено!*\n\n"
+        f"📦 Товар ID: {product_id}\n"
+        f"📝 Новое значение: *{tag_title(value) if field == 'tag' else value}*\n\n"
+        f"💰 Стоимость: *{updated_product['cost']:.0f}₽*\n"
+        f"💸 Расходы: *{updated_product['expenses']:.0f}₽*\n"
+        f"🏷️ Итоговая цена: *{updated_product['final_price']:.0f}₽*\n"
+        f"🎯 Прибыль: *{updated_product['profit']:.0f}₽*"
+    )
+    
+    await reply(update, message, parse_mode='Markdown')
+    await start(update, context)
+    return END
+
+# Удаление - выбор товара
+@dialog.state(
+    States.DELETING_SELECT_PRODUCT, parse_number, "❌ Введите корректный ID товара (число)",
+    transitions=[States.DELETE_CONFIRMATION]
+)
+async def on_deleting_select_product(update, context, session, product_id):
+    product = product_manager.get_product(product_id)
+    if not product:
+        await reply(update, "❌ Товар с таким ID не найден")
+        return None
+    
+    # Подтверждение удаления
+    message = (
+        f"⚠️ *ПОДТВЕРЖДЕНИЕ УДАЛЕНИЯ*\n\n"
+        f"📦 Товар ID: {product_id}\n"
+        f"📝 Название: *{product['name']}*\n"
+        f"💰 Стоимость: *{product['cost']:.0f}₽*\n"
+        f"🎯 Прибыль: *{product['profit']:.0f}₽*\n\n"
+        "Для подтверждения введите:\n"
+        "✅ *ДА* - удалить товар\n"
+        "❌ *НЕТ* - отменить удаление"
+    )
+    
+    session['product_id'] = product_id
+    
+    keyboard = [['🔙 Главное меню']]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    
+    await reply(update, message, reply_markup=reply_markup, parse_mode='Markdown')
+    return States.DELETE_CONFIRMATION
+
+# Подтверждение удаления
+@dialog.state(States.DELETE_CONFIRMATION, transitions=[END])
+async def on_delete_confirmation(update, context, session, text):
+    if text.upper() in ['ДА', 'YES', 'Y', 'УДАЛИТЬ']:
+        product_id = session['product_id']
+        if product_manager.delete_product(product_id, user_id=update.message.from_user.id):
+            await reply(
+                update,
+                f"✅ *Товар ID: {product_id} успешно удален!*",
                 parse_mode='Markdown'
             )
+        else:
+            await reply(update, "❌ Ошибка при удалении товара")
+    else:
+        await reply(update, "❌ Удаление отменено")
+    
+    await start(update, context)
+    return END
+
+def format_daily_summary(date, stats):
+    """Ежедневная сводка за завершившийся день"""
+    if not stats:
+        return f"🌙 *СВОДКА ЗА {date}*\n\n📭 Продаж не было"
+    
+    profitability = (stats['total_profit'] / stats['total_final'] * 100) if stats['total_final'] > 0 else 0
+    return (
+        f"🌙 *СВОДКА ЗА {date}*\n\n"
+        f"📦 *Товаров:* {stats['count']}\n"
+        f"💰 *Общая стоимость:* {stats['total_cost']:.0f}₽\n"
+        f"💸 *Общие расходы:* {stats['total_expenses']:.0f}₽\n"
+        f"🏷️ *Общий итог:* {stats['total_final']:.0f}₽\n"
+        f"🎯 *Общая прибыль:* {stats['total_profit']:.0f}₽\n"
+        f"📊 *Рентабельность:* {profitability:.1f}%"
+    )
+
+async def rollup_job(context: ContextTypes.DEFAULT_TYPE):
+    """Ночная заморозка агрегатов за прошедший день и рассылка сводки"""
+    today = datetime.now().strftime("%Y-%m-%d")
+    product_manager.freeze_rollups(today)
+    product_manager.seal_cold_months(today)
+    
+    yesterday = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+    logger.info(f"🧊 Агрегаты заморожены по {yesterday}")
+    
+    message = format_daily_summary(yesterday, product_manager.rollups.daily.get(yesterday))
+    for chat_id in subscription_manager.chat_ids:
+        outbound_queue.enqueue(chat_id, 'send_message', Priority.LOW, text=message, parse_mode='Markdown')
+
+# Названия событий журнала для сообщений
+EVENT_NAMES = {
+    'add': 'добавление товара',
+    'update': 'изменение товара',
+    'delete': 'удаление товара'
+}
+
+async def undo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /undo - отмена последнего изменения пользователя"""
+    event, undone = product_manager.undo_last_change(update.effective_user.id)
+    
+    if event is None:
+        await reply(update, "↩️ *Нечего отменять*", parse_mode='Markdown')
+    elif undone:
+        name = event['product']['name'] if 'product' in event else event['name']
+        await reply(update, f"↩️ *Отменено:* {EVENT_NAMES[event['type']]} «{name}»", parse_mode='Markdown')
+    else:
+        await reply(
+            update,
+            f"⚠️ *Не удалось отменить* {EVENT_NAMES[event['type']]}: товар уже изменен другим действием",
+            parse_mode='Markdown'
+        )
+
+async def evict_segments_job(context: ContextTypes.DEFAULT_TYPE):
+    """Выгрузка из памяти архивных сегментов, которые давно не открывали"""
+    evicted = product_manager.cold.evict_idle(SEGMENT_IDLE_SECONDS)
+    if evicted:
+        logger.info(f"📦 Выгружены архивные сегменты: {', '.join(evicted)}")
+
+# Графики: период по умолчанию, предельный период и размер кэша картинок
+CHART_DEFAULT_DAYS = 30
+CHART_MAX_DAYS = 366
+CHART_CACHE_SIZE = 16
+CHART_WORKERS = 2
+
+class ChartRenderer:
+    """Отрисовка графиков в пуле процессов с LRU-кэшем по (период, версия данных)"""
+    def __init__(self, cache_size=CHART_CACHE_SIZE, workers=CHART_WORKERS):
+        self.cache_size = cache_size
+        self.workers = workers
+        self._cache = OrderedDict()  # ключ -> (PNG, подпись)
+        self._pending = {}           # ключ -> отрисовка, которая уже идет
+        self._pool = None
+        self.metrics = {'hits': 0, 'misses': 0}
+    
+    def get(self, key):
+        """Готовые картинка и подпись из кэша или None"""
+        chart = self._cache.get(key)
+        if chart is not None:
+            self._cache.move_to_end(key)
+            self.metrics['hits'] += 1
+        return chart
+    
+    async def render(self, key, title, dates, series, caption):
+        """Отрисовка в пуле процессов: цикл событий не блокируется; возвращает (PNG, подпись)"""
+        if key in self._pending:
+            # Тот же график уже рисуется по другому запросу - ждем его
+            return await asyncio.shield(self._pending[key]), caption
         
-        elif state == States.WAITING_COST:
-            try:
-                user_sessions[user_id]['cost'] = float(text)
-                user_sessions[user_id]['state'] = States.WAITING_EXPENSES
-                
-                keyboard = [['🔙 Отмена']]
-                reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                
-                await update.message.reply_text(
-                    "💸 Введите расходы:",
-                    reply_markup=reply_markup,
-                    parse_mode='Markdown'
-                )
-            except ValueError:
-                await update.message.reply_text("❌ Введите корректное число для стоимости")
-        
-        elif state == States.WAITING_EXPENSES:
-            try:
-                user_sessions[user_id]['expenses'] = float(text)
-                user_sessions[user_id]['state'] = States.WAITING_FINAL_PRICE
-                
-                keyboard = [['🔙 Отмена']]
-                reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                
-                await update.message.reply_text(
-                    "🏷️ Введите итоговую цену:",
-                    reply_markup=reply_markup,
-                    parse_mode='Markdown'
-                )
-            except ValueError:
-                await update.message.reply_text("❌ Введите корректное число для расходов")
-        
-        elif state == States.WAITING_FINAL_PRICE:
-            try:
-                final_price = float(text)
-                session_data = user_sessions[user_id]
-                
-                # Добавляем товар
-                product = product_manager.add_product(
-                    session_data['name'],
-                    session_data['cost'],
-                    session_data['expenses'],
-                    final_price
-                )
-                
-                # Показываем результат
-                message = (
-                    "✅ *Товар успешно добавлен!*\n\n"
-                    f"📦 Название: *{product['name']}*\n"
-                    f"💰 Стоимость: *{product['cost']:.0f}₽*\n"
-                    f"💸 Расходы: *{product['expenses']:.0f}₽*\n"
-                    f"🏷️ Итоговая цена: *{product['final_price']:.0f}₽*\n"
-                    f"🎯 Прибыль: *{product['profit']:.0f}₽*\n"
-                    f"📅 Дата добавления: *{product['date']}*\n\n"
-                    f"📈 Рентабельность: *{(product['profit']/product['final_price']*100):.1f}%*"
-                )
-                
-                await update.message.reply_text(message, parse_mode='Markdown')
-                
-                # Очищаем сессию и возвращаем в главное меню
-                del user_sessions[user_id]
-                await start(update, context)
-                
-            except ValueError:
-                await update.message.reply_text("❌ Введите корректное число для итоговой цены")
-        
-        # Статистика по дате - ввод даты
-        elif state == States.SELECTING_DATE_FOR_STATS:
-            # Проверяем формат даты (ГГГГ-ММ-ДД)
-            try:
-                datetime.strptime(text, '%Y-%m-%d')
-                stats_by_date = product_manager.get_statistics_by_date(text)
-                message = format_date_statistics(stats_by_date, text)
-                
-                keyboard = [
-                    ['📅 Статистика по дате'],
-                    ['🔙 Главное меню']
-                ]
-                reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                
-                await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
-                del user_sessions[user_id]
-                
-            except ValueError:
-                await update.message.reply_text(
-                    "❌ *Неверный формат даты!*\n\n"
-                    "Введите дату в формате *ГГГГ-ММ-ДД*\n"
-                    "Пример: *2024-01-15*",
-                    parse_mode='Markdown'
-                )
-        
-        # Редактирование - выбор товара
-        elif state == States.EDITING_SELECT_PRODUCT:
-            if text.isdigit():
-                product_id = int(text)
-                product = product_manager.get_product(product_id)
-                
-                if product:
-                    user_sessions[user_id] = {
-                        'state': States.EDITING_SELECT_FIELD,
-                        'product_id': product_id
-                    }
-                    await show_edit_fields_menu(update, context, product_id)
-                else:
-                    await update.message.reply_text("❌ Товар с таким ID не найден")
-            else:
-                await update.message.reply_text("❌ Введите корректный ID товара (число)")
-        
-        # Редактирование - выбор поля
-        elif state == States.EDITING_SELECT_FIELD:
-            if text.isdigit():
-                choice = int(text)
-                field_map = {
-                    1: 'name',
-                    2: 'cost', 
-                    3: 'expenses',
-                    4: 'final_price'
-                }
-                
-                if choice == 0:
-                    del user_sessions[user_id]
-                    await start(update, context)
-                    return
-                
-                if choice in field_map:
-                    field = field_map[choice]
-                    user_sessions[user_id] = {
-                        'state': States.EDITING_INPUT_VALUE,
-                        'product_id': session['product_id'],
-                        'field': field
-                    }
-                    
-                    field_names = {
-                        'name': 'название',
-                        'cost': 'стоимость',
-                        'expenses': 'расходы',
-                        'final_price': 'итоговую цену'
-                    }
-                    
-                    keyboard = [['🔙 Отмена']]
-                    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                    
-                    await update.message.reply_text(
-                        f"✏️ Введите новое значение для {field_names[field]}:",
-                        reply_markup=reply_markup,
-                        parse_mode='Markdown'
-                    )
-                else:
-                    await update.message.reply_text("❌ Неверный выбор. Введите цифру от 1 до 4")
-            else:
-                await update.message.reply_text("❌ Введите цифру от 1 до 4")
+        self.metrics['misses'] += 1
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor(), render_chart_png, title, dates, series)
+        self._pending[key] = future
+        try:
+            png = await future
+        finally:
+            del self._pending[key]
         
-        # Редактирование - ввод значения
-        elif state == States.EDITING_INPUT_VALUE:
-            product_id = session['product_id']
-            field = session['field']
-            
-            try:
-                # Валидация числовых полей
-                if field in ['cost', 'expenses', 'final_price']:
-                    value = float(text)
-                else:
-                    value = text
-                
-                updated_product = product_manager.update_product_field(product_id, field, value)
-                
-                if updated_product:
-                    field_names = {
-                        'name': 'название',
-                        'cost': 'стоимость', 
-                        'expenses': 'расходы',
-                        'final_price': 'итоговую цену'
-                    }
-                    
-                    message = (
-                        f"✅ *{field_names[field].title()} успешно обновлено!*\n\n"
-                        f"📦 Товар ID: {product_id}\n"
-                        f"📝 Новое значение: *{value}*\n\n"
-                        f"💰 Стоимость: *{updated_product['cost']:.0f}₽*\n"
-                        f"💸 Расходы: *{updated_product['expenses']:.0f}₽*\n" 
-                        f"🏷️ Итоговая цена: *{updated_product['final_price']:.0f}₽*\n"
-                        f"🎯 Прибыль: *{updated_product['profit']:.0f}₽*"
-                    )
-                    
-                    await update.message.reply_text(message, parse_mode='Markdown')
-                    del user_sessions[user_id]
-                    await start(update, context)
-                else:
-                    await update.message.reply_text("❌ Ошибка при обновлении товара")
-                    
-            except ValueError:
-                await update.message.reply_text("❌ Введите корректное числовое значение")
-        
-        # Удаление - выбор товара
-        elif state == States.DELETING_SELECT_PRODUCT:
-            if text.isdigit():
-                product_id = int(text)
-                product = product_manager.get_product(product_id)
-                
-                if product:
-                    # Подтверждение удаления
-                    message = (
-                        f"⚠️ *ПОДТВЕРЖДЕНИЕ УДАЛЕНИЯ*\n\n"
-                        f"📦 Товар ID: {product_id}\n"
-                        f"📝 Название: *{product['name']}*\n"
-                        f"💰 Стоимость: *{product['cost']:.0f}₽*\n"
-                        f"🎯 Прибыль: *{product['profit']:.0f}₽*\n\n"
-                        "Для подтверждения введите:\n"
-                        "✅ *ДА* - удалить товар\n"
-                        "❌ *НЕТ* - отменить удаление"
-                    )
-                    
-                    user_sessions[user_id] = {
-                        'state': 'DELETE_CONFIRMATION',
-                        'product_id': product_id
-                    }
-                    
-                    keyboard = [['🔙 Главное меню']]
-                    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-                    
-                    await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
-                else:
-                    await update.message.reply_text("❌ Товар с таким ID не найден")
-            else:
-                await update.message.reply_text("❌ Введите корректный ID товара (число)")
-        
-        # Подтверждение удаления
-        elif state == 'DELETE_CONFIRMATION':
-            if text.upper() in ['ДА', 'YES', 'Y', 'УДАЛИТЬ']:
-                product_id = session['product_id']
-                if product_manager.delete_product(product_id):
-                    await update.message.reply_text(
-                        f"✅ *Товар ID: {product_id} успешно удален!*",
-                        parse_mode='Markdown'
-                    )
-                else:
-                    await update.message.reply_text("❌ Ошибка при удалении товара")
-            else:
-                await update.message.reply_text("❌ Удаление отменено")
-            
-            del user_sessions[user_id]
-            await start(update, context)
+        chart = self._cache[key] = (png, caption)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return chart
     
+    def stop(self):
+        """Остановка пула процессов"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+    
+    def _executor(self):
+        if self._pool is None:
+            # spawn: чистые процессы без копии потоков и цикла событий бота;
+            # модуль бота при импорте данных не трогает (см. load_managers)
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+# Графики динамики
+chart_renderer = ChartRenderer()
+
+def parse_chart_range(args):
+    """Период графика из аргументов: пусто, число дней или две даты"""
+    today = datetime.now()
+    if not args:
+        days = CHART_DEFAULT_DAYS
+    elif len(args) == 1:
+        days = parse_number(args[0])
+    elif len(args) == 2:
+        start, end = (datetime.strptime(parse_date(arg), '%Y-%m-%d') for arg in args)
+        days = (end - start).days + 1
+        today = end
     else:
-        # Если сообщение не распознано
-        await update.message.reply_text(
-            "🤖 Используйте кнопки меню для навигации",
-            parse_mode='Markdown'
+        raise ValueError(args)
+    
+    if not 1 <= days <= CHART_MAX_DAYS:
+        raise ValueError(days)
+    start = today - timedelta(days=days - 1)
+    return start.strftime('%Y-%m-%d'), today.strftime('%Y-%m-%d')
+
+def build_chart_data(start_date, end_date):
+    """Дневные ряды прибыли, выручки и расходов; дни без продаж - нули"""
+    stats_by_date = product_manager.get_statistics_by_date() or {}
+    start = datetime.strptime(start_date, '%Y-%m-%d')
+    days = (datetime.strptime(end_date, '%Y-%m-%d') - start).days + 1
+    dates = [(start + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(days)]
+    
+    empty = empty_totals()
+    rows = [stats_by_date.get(date, empty) for date in dates]
+    series = [
+        ('Прибыль', [row['total_profit'] for row in rows], 'tab:green'),
+        ('Выручка', [row['total_final'] for row in rows], 'tab:blue'),
+        ('Расходы', [row['total_expenses'] for row in rows], 'tab:red')
+    ]
+    
+    title = f'Динамика с {start_date} по {end_date}'
+    caption = (
+        f"📉 *ДИНАМИКА* {start_date} — {end_date}\n"
+        f"🏷️ Выручка: {sum(row['total_final'] for row in rows):.0f}₽\n"
+        f"💸 Расходы: {sum(row['total_expenses'] for row in rows):.0f}₽\n"
+        f"🎯 Прибыль: {sum(row['total_profit'] for row in rows):.0f}₽"
+    )
+    return title, dates, series, caption
+
+CHART_USAGE = (
+    "❌ Неверный период. Примеры:\n"
+    f"/chart - последние {CHART_DEFAULT_DAYS} дней\n"
+    "/chart 7 - последние 7 дней\n"
+    "/chart 2024-01-01 2024-01-31"
+)
+
+async def chart_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /chart - график прибыли, выручки и расходов по дням"""
+    try:
+        start_date, end_date = parse_chart_range(context.args or [])
+    except ValueError:
+        await reply(update, CHART_USAGE)
+        return
+    
+    # При попадании в кэш историю не читаем: картинка и подпись хранятся вместе
+    key = (start_date, end_date, product_manager.version)
+    chart = chart_renderer.get(key)
+    if chart is None:
+        try:
+            chart = await chart_renderer.render(key, *build_chart_data(start_date, end_date))
+        except Exception as e:
+            logger.error(f"Ошибка построения графика: {e}")
+            await reply(update, "❌ Не удалось построить график")
+            return
+    
+    png, caption = chart
+    await reply_photo(update, png, caption=caption, parse_mode='Markdown')
+
+def format_alert(kind, date, details):
+    """Текст оповещения"""
+    if kind == 'loss':
+        return (
+            f"🚨 *Продажа в убыток* ({date})\n\n"
+            f"📦 {details['name']}\n"
+            f"🏷️ Цена: {details['final_price']:.0f}₽\n"
+            f"🎯 Прибыль: {details['profit']:.0f}₽"
         )
+    if kind == 'margin':
+        return (
+            f"📉 *Рентабельность дня ниже порога* ({date})\n\n"
+            f"📊 {details['margin']:.1f}% при пороге {details['threshold']:.1f}%"
+        )
+    return (
+        f"💸 *Расходы дня превысили бюджет* ({date})\n\n"
+        f"💸 {details['expenses']:.0f}₽ при бюджете {details['budget']:.0f}₽"
+    )
+
+def send_alert(chat_id, kind, date, details):
+    """Отправка оповещения через очередь исходящих сообщений"""
+    outbound_queue.enqueue(
+        int(chat_id), 'send_message', Priority.NORMAL,
+        text=format_alert(kind, date, details), parse_mode='Markdown'
+    )
+
+def format_alert_rules(rules):
+    """Текущие правила оповещений чата"""
+    loss = '✅ вкл.' if rules['loss'] else '❌ выкл.'
+    margin = f"ниже {rules['margin']:.1f}%" if rules['margin'] is not None else '❌ выкл.'
+    budget = f"больше {rules['budget']:.0f}₽" if rules['budget'] is not None else '❌ выкл.'
+    return (
+        "🔔 *ОПОВЕЩЕНИЯ*\n\n"
+        f"🚨 Продажа в убыток: {loss}\n"
+        f"📉 Рентабельность дня: {margin}\n"
+        f"💸 Расходы дня: {budget}\n\n"
+        "*Настройка:*\n"
+        "/alerts loss on|off\n"
+        "/alerts margin 15|off\n"
+        "/alerts budget 5000|off"
+    )
+
+async def alerts_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /alerts - просмотр и настройка оповещений чата"""
+    chat_id = update.effective_chat.id
+    args = context.args or []
+    
+    if len(args) == 2:
+        rule, value = args[0].lower(), args[1].lower()
+        try:
+            if rule == 'loss' and value in ('on', 'off'):
+                product_manager.alerts.set_rule(chat_id, 'loss', value == 'on')
+            elif rule in ('margin', 'budget'):
+                product_manager.alerts.set_rule(chat_id, rule, None if value == 'off' else parse_amount(value))
+            else:
+                raise ValueError(rule)
+        except ValueError:
+            await reply(update, "❌ Неверная настройка. Пример: /alerts margin 15")
+            return
+    elif args:
+        await reply(update, "❌ Неверная настройка. Пример: /alerts margin 15")
+        return
+    
+    await reply(update, format_alert_rules(product_manager.alerts.get_rules(chat_id)), parse_mode='Markdown')
+
+async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /subscribe - ежедневная сводка в этот чат"""
+    subscription_manager.subscribe(update.effective_chat.id)
+    await reply(update, "🔔 *Ежедневная сводка включена*", parse_mode='Markdown')
+
+async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /unsubscribe - отключить ежедневную сводку"""
+    subscription_manager.unsubscribe(update.effective_chat.id)
+    await reply(update, "🔕 *Ежедневная сводка отключена*", parse_mode='Markdown')
+
+def format_queue_metrics(metrics):
+    """Метрики очереди исходящих сообщений"""
+    return (
+        "📡 *ОЧЕРЕДЬ ОТПРАВКИ*\n"
+        f"📥 В очереди: {metrics['queue_depth']} (макс. {metrics['max_queue_depth']})\n"
+        f"📤 Отправлено: {metrics['sent']}\n"
+        f"🔗 Склеено: {metrics['merged']}\n"
+        f"🔁 Повторов: {metrics['retries']}\n"
+        f"❌ Ошибок: {metrics['failed']}\n"
+        f"⏱️ Задержка: {metrics['latency_avg'] * 1000:.0f} мс (p95 {metrics['latency_p95'] * 1000:.0f} мс)"
+    )
+
+def format_dialog_timings(timings):
+    """Время обработки переходов диалога, самые медленные сверху"""
+    if not timings:
+        return "⏱️ *Переходов диалога еще не было*"
+    
+    message = "⏱️ *ПЕРЕХОДЫ ДИАЛОГА*\n"
+    slowest = sorted(timings.items(), key=lambda item: item[1]['total'] / item[1]['count'], reverse=True)
+    for key, stats in slowest[:10]:
+        avg = stats['total'] / stats['count'] * 1000
+        # Подчеркивания в именах состояний ломают Markdown
+        key = key.replace('_', '\\_')
+        message += f"• {key}: {stats['count']} × {avg:.1f} мс (макс. {stats['max'] * 1000:.1f} мс)\n"
+    
+    return message
+
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /metrics - состояние очереди отправки и время обработки диалога"""
+    message = format_queue_metrics(outbound_queue.get_metrics())
+    message += "\n\n" + format_dialog_timings(dialog.timings)
+    message += (
+        f"\n\n📉 *Графики:* из кэша {chart_renderer.metrics['hits']}, "
+        f"построено {chart_renderer.metrics['misses']}"
+    )
+    await reply(update, message, parse_mode='Markdown')
+
+async def on_startup(application: Application):
+    """Запуск очереди исходящих сообщений"""
+    outbound_queue.start(application.bot)
+    product_manager.alerts.notify = send_alert
+
+async def on_stop(application: Application):
+    """Доотправка сообщений перед остановкой"""
+    await outbound_queue.stop()
+    chart_renderer.stop()
 
 def main():
     """Основная функция запуска бота"""
@@ -855,14 +2935,38 @@ def main():
         logger.error("❌ BOT_TOKEN не найден!")
         return
     
+    load_managers()
+    
     try:
         logger.info("🚀 Создаем приложение бота...")
         
         # Создаем приложение
-        application = Application.builder().token(BOT_TOKEN).build()
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .post_init(on_startup)
+            .post_stop(on_stop)
+            .build()
+        )
         
         # Добавляем обработчики
         application.add_handler(CommandHandler("start", start))
+        application.add_handler(CommandHandler("metrics", metrics_command))
+        application.add_handler(CommandHandler("undo", undo_command))
+        application.add_handler(CommandHandler("alerts", alerts_command))
+        # Отрисовка может занять секунды: не задерживаем обработку апдейтов других пользователей
+        application.add_handler(CommandHandler("chart", chart_command, block=False))
+        application.add_handler(CommandHandler("subscribe", subscribe_command))
+        application.add_handler(CommandHandler("unsubscribe", unsubscribe_command))
+        application.add_handler(CallbackQueryHandler(handle_callback))
+        
+        # Ночная заморозка агрегатов и выгрузка архива
+        if application.job_queue:
+            tzinfo = datetime.now().astimezone().tzinfo
+            application.job_queue.run_daily(rollup_job, time=ROLLUP_TIME.replace(tzinfo=tzinfo))
+            application.job_queue.run_repeating(evict_segments_job, interval=SEGMENT_IDLE_SECONDS)
+        else:
+            logger.warning("⚠️ JobQueue недоступна, установите python-telegram-bot[job-queue]")
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
         
         # Запускаем бота
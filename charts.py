@@ -0,0 +1,29 @@
+"""Отрисовка графиков. Модуль без побочных эффектов при импорте: его загружают процессы пула"""
+import io
+from datetime import datetime
+
+def render_chart_png(title, dates, series):
+    """Отрисовка графика в PNG, выполняется в процессе пула"""
+    # matplotlib нужен только процессам пула, основной процесс его не загружает
+    from matplotlib.figure import Figure
+    from matplotlib.dates import AutoDateLocator, ConciseDateFormatter
+    
+    days = [datetime.strptime(date, '%Y-%m-%d') for date in dates]
+    figure = Figure(figsize=(10, 5), dpi=100)
+    ax = figure.subplots()
+    for label, values, color in series:
+        ax.plot(days, values, label=label, color=color, marker='o' if len(days) <= 31 else None, markersize=3)
+    
+    ax.axhline(0, color='gray', linewidth=0.8)
+    locator = AutoDateLocator()
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(ConciseDateFormatter(locator))
+    ax.set_title(title)
+    ax.set_ylabel('₽')
+    ax.grid(alpha=0.3)
+    ax.legend(loc='upper left')
+    figure.tight_layout()
+    
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png')
+    return buffer.getvalue()
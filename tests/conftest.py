@@ -0,0 +1,132 @@
+import os
+import sys
+import time
+import asyncio
+import importlib
+import json
+import itertools
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import RetryAfter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class FakeBot:
+    """Локальная имитация Bot API для проверки очереди без Telegram"""
+    def __init__(self, flood_limit=3, latency=0.0):
+        self.flood_limit = flood_limit
+        self.latency = latency
+        self.calls = []
+        self._recent = defaultdict(deque)
+        self._message_ids = itertools.count(1)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self._call('send_message', chat_id, text=text, **kwargs)
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        return await self._call('edit_message_text', chat_id, message_id=message_id, text=text, **kwargs)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        return await self._call('send_photo', chat_id, photo=photo, **kwargs)
+
+    async def _call(self, method, chat_id, **kwargs):
+        await asyncio.sleep(self.latency)
+
+        # Как и настоящий Telegram, отвечаем 429 при превышении лимита на чат
+        now = time.monotonic()
+        recent = self._recent[chat_id]
+        while recent and now - recent[0] > 1:
+            recent.popleft()
+        if len(recent) >= self.flood_limit:
+            raise RetryAfter(1)
+        recent.append(now)
+
+        # Редактирование сохраняет номер сообщения, отправка выдает новый
+        message_id = kwargs.pop('message_id', None) or next(self._message_ids)
+        message = SimpleNamespace(message_id=message_id, chat_id=chat_id, method=method, sent_at=now, **kwargs)
+        self.calls.append(message)
+        return message
+
+@pytest.fixture(scope='session')
+def bot():
+    """Модуль бота: при импорте он данных не читает и файлов не пишет"""
+    return importlib.import_module('bot')
+
+class Clock:
+    """Управляемое время для datetime.now() в модуле бота"""
+    def __init__(self, now):
+        self.current = now
+
+    def set(self, value):
+        self.current = datetime.strptime(value, '%Y-%m-%d %H:%M')
+
+    def advance(self, **kwargs):
+        self.current += timedelta(**kwargs)
+
+@pytest.fixture
+def clock(bot, monkeypatch):
+    """Подмена текущего времени; в сигнатуре теста ставится раньше manager"""
+    clock = Clock(datetime.now())
+
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return clock.current
+
+    monkeypatch.setattr(bot, 'datetime', FrozenDatetime)
+    return clock
+
+@pytest.fixture
+def manager(bot, tmp_path, monkeypatch):
+    """Свежий менеджер товаров в собственном каталоге данных, подставленный в модуль бота"""
+    monkeypatch.chdir(tmp_path)
+    product_manager = bot.ProductManager()
+    monkeypatch.setattr(bot, 'product_manager', product_manager)
+    monkeypatch.setattr(bot, 'subscription_manager', bot.SubscriptionManager())
+    monkeypatch.setattr(bot, 'outbound_queue', bot.OutboundQueue())
+    yield product_manager
+    # Диалоговый движок держит ссылку на общий словарь сессий
+    bot.user_sessions.clear()
+
+def make_update(text, user_id=1):
+    """Входящее текстовое сообщение пользователя"""
+    user = SimpleNamespace(id=user_id)
+    message = SimpleNamespace(from_user=user, text=text, chat_id=user_id)
+    return SimpleNamespace(message=message, effective_chat=SimpleNamespace(id=user_id), effective_user=user)
+
+def make_callback(data, message_id=1, user_id=1):
+    """Нажатие inline-кнопки под сообщением message_id"""
+    async def answer(*args, **kwargs):
+        pass
+    user = SimpleNamespace(id=user_id)
+    message = SimpleNamespace(chat_id=user_id, message_id=message_id)
+    query = SimpleNamespace(data=data, answer=answer, from_user=user, message=message)
+    return SimpleNamespace(callback_query=query, message=None, effective_chat=SimpleNamespace(id=user_id), effective_user=user)
+
+def make_product(i, date, **fields):
+    """Товар в формате products.json"""
+    product = {
+        'id': i, 'name': f'P{i}', 'cost': 100.0, 'expenses': 10.0,
+        'final_price': 150.0, 'profit': 40.0,
+        'created_at': f'{date} 10:00:00', 'date': date
+    }
+    product.update(fields)
+    product['profit'] = product['final_price'] - product['cost'] - product['expenses']
+    return product
+
+@pytest.fixture
+def seed(bot, manager, tmp_path, monkeypatch):
+    """Запуск на готовых товарах: seed(products) -> новый менеджер в чистом каталоге данных"""
+    def load(products):
+        data_dir = tmp_path / 'seed'
+        data_dir.mkdir()
+        monkeypatch.chdir(data_dir)
+        with open('products.json', 'w', encoding='utf-8') as f:
+            json.dump(sorted(products, key=lambda p: p['date']), f, ensure_ascii=False)
+        product_manager = bot.ProductManager()
+        monkeypatch.setattr(bot, 'product_manager', product_manager)
+        return product_manager
+    return load
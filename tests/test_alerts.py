@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import make_product
+
+@pytest.fixture
+def alerts(bot, tmp_path, monkeypatch):
+    """Менеджер оповещений с правилом убытка, управляемым временем и списком уведомлений"""
+    monkeypatch.chdir(tmp_path)
+    now = [1_000_000.0]
+    monkeypatch.setattr(bot.time, 'time', lambda: now[0])
+    alerts = bot.AlertManager()
+    alerts.sent = []
+    alerts.now = now
+    alerts.notify = lambda chat_id, kind, date, details: alerts.sent.append((chat_id, kind, date))
+    alerts.set_rule(1, 'loss', True)
+    return alerts
+
+def evaluate(bot, alerts, product):
+    totals = bot.empty_totals()
+    bot.add_to_totals(totals, product)
+    alerts.evaluate(product, totals)
+
+def days_ago(days):
+    return (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+
+def test_alert_fires_once_while_condition_holds(bot, alerts):
+    product = make_product(1, days_ago(0), final_price=50, uid='a')
+    for _ in range(3):
+        evaluate(bot, alerts, product)
+        alerts.now[0] += 2 * bot.ALERT_COOLDOWN
+    assert alerts.sent == [('1', 'loss', days_ago(0))]
+    # Состояние переживает перезапуск
+    assert bot.AlertManager().state == alerts.state
+
+def test_alert_rearms_after_condition_clears_and_respects_cooldown(bot, alerts):
+    losing = make_product(1, days_ago(1), final_price=50, uid='a')
+    fixed = dict(losing, final_price=500, profit=390)
+
+    evaluate(bot, alerts, losing)
+    evaluate(bot, alerts, fixed)
+    # Условие вернулось раньше окончания паузы - молчим
+    alerts.now[0] += bot.ALERT_COOLDOWN / 2
+    evaluate(bot, alerts, losing)
+    assert len(alerts.sent) == 1
+
+    evaluate(bot, alerts, fixed)
+    alerts.now[0] += bot.ALERT_COOLDOWN
+    evaluate(bot, alerts, losing)
+    assert len(alerts.sent) == 2
+
+def test_products_older_than_state_window_do_not_alert(bot, alerts):
+    old = make_product(1, days_ago(bot.ALERT_STATE_DAYS + 1), final_price=50, uid='a')
+    for _ in range(3):
+        evaluate(bot, alerts, old)
+    assert alerts.sent == []
+
+    edge = make_product(2, days_ago(bot.ALERT_STATE_DAYS), final_price=50, uid='b')
+    evaluate(bot, alerts, edge)
+    evaluate(bot, alerts, edge)
+    assert len(alerts.sent) == 1
@@ -0,0 +1,53 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import make_callback, make_product
+
+@pytest.fixture
+def products(seed):
+    """25 товаров за последние 25 дней: 3 страницы списка и 3 страницы дат"""
+    today = datetime.now()
+    return seed([
+        make_product(i + 1, (today - timedelta(days=24 - i)).strftime('%Y-%m-%d'))
+        for i in range(25)
+    ])
+
+def click(bot, data, message_id):
+    """Нажатие кнопки; возвращает поставленные в очередь вызовы Bot API"""
+    asyncio.run(bot.handle_callback(make_callback(data, message_id), None))
+    return [item for item in bot.outbound_queue._queue._queue if item.kwargs.get('message_id') == message_id]
+
+def callbacks(item):
+    return [button.callback_data for row in item.kwargs['reply_markup'].inline_keyboard for button in row]
+
+@pytest.mark.parametrize('data, page', [('list:2', 2), ('list:99', 3), ('list:0', 1)])
+def test_list_pages_round_trip_and_clamp(bot, products, data, page):
+    [item] = click(bot, data, message_id=10)
+    assert item.method == 'edit_message_text'
+    assert f'Страница {page} из 3' in item.kwargs['text']
+    data = callbacks(item)
+    assert (f'list:{page - 1}' in data) == (page > 1)
+    assert (f'list:{page + 1}' in data) == (page < 3)
+
+def test_dates_page_and_date_report_round_trip(bot, products):
+    [page] = click(bot, 'dates:99', message_id=20)
+    data = callbacks(page)
+    # Последняя страница - самые старые даты, назад листать некуда
+    assert 'dates:2' in data and 'dates:4' not in data
+    date = next(item for item in data if item.startswith('date:'))[5:]
+
+    [report] = click(bot, f'date:{date}', message_id=21)
+    assert report.method == 'edit_message_text'
+    assert f'СТАТИСТИКА ЗА {date}' in report.kwargs['text']
+    # Возврат к той странице списка дат, на которой была дата
+    assert 'dates:3' in callbacks(report)
+
+def test_one_edit_is_queued_per_click(bot, products):
+    for message_id, data in enumerate(['list:1', 'list:2', 'dates:1', 'stats', 'top:top_profit:all'], 1):
+        assert [item.method for item in click(bot, data, message_id)] == ['edit_message_text']
+    assert bot.outbound_queue._pending == 5
+
+def test_broken_callback_data_is_ignored(bot, products):
+    assert click(bot, 'list:abc', message_id=30) == []
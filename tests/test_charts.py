@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('matplotlib')
+
+def test_chart_is_rendered_in_pool_and_served_from_cache(bot, manager, monkeypatch):
+    renderer = bot.ChartRenderer(cache_size=2)
+    monkeypatch.setattr(bot, 'chart_renderer', renderer)
+    # Считаем задания, реально отправленные в пул процессов
+    submitted = []
+    executor = renderer._executor
+
+    class CountingPool:
+        def submit(self, fn, *args):
+            submitted.append(args[0])
+            return executor().submit(fn, *args)
+    monkeypatch.setattr(renderer, '_executor', CountingPool)
+    sent = []
+
+    async def fake_reply_photo(update, photo, **kwargs):
+        sent.append((photo, kwargs['caption']))
+    monkeypatch.setattr(bot, 'reply_photo', fake_reply_photo)
+
+    update = None
+    context = type('Context', (), {'args': ['7']})()
+    manager.add_product('Зонт', 100, 10, 300)
+
+    async def scenario():
+        # Обработчик зарегистрирован с block=False: PTB выполняет такие запросы одновременно
+        await asyncio.gather(bot.chart_command(update, context), bot.chart_command(update, context))
+        assert len(submitted) == 1
+
+        # Повторный запрос не читает историю: все берется из кэша
+        def no_history(*args):
+            raise AssertionError('build_chart_data при попадании в кэш')
+        with monkeypatch.context() as patch:
+            patch.setattr(bot, 'build_chart_data', no_history)
+            await bot.chart_command(update, context)
+
+        # Новая версия данных - новый график
+        manager.add_product('Зонт', 100, 10, 500)
+        await bot.chart_command(update, context)
+        renderer.stop()
+
+    asyncio.run(scenario())
+    assert [photo[:8] for photo, _ in sent] == [b'\x89PNG\r\n\x1a\n'] * 4
+    assert sent[0] == sent[1] == sent[2] and sent[3] != sent[0]
+    assert renderer.metrics == {'hits': 1, 'misses': 2}
+    assert len(submitted) == 2
+    assert len(renderer._cache) == 2
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from conftest import make_update
+
+def test_add_product_dialog_starts_from_button_and_ends(bot, manager):
+    async def scenario():
+        await bot.dialog.dispatch(make_update('📦 Добавить товар', 42), None)
+        started = dict(bot.user_sessions[42])
+        for text in ['Зонт', '100', '10', '300', '-']:
+            await bot.dialog.dispatch(make_update(text, 42), None)
+        return started
+
+    started = asyncio.run(scenario())
+    assert started == {'state': bot.States.WAITING_NAME}
+    assert 42 not in bot.user_sessions
+    product = manager.get_recent_products(1)[0]
+    assert (product['name'], product['profit'], product['tag']) == ('Зонт', 190, '')
+
+@pytest.mark.parametrize('label, state', [
+    ('✏️ Редактировать', 'EDITING_SELECT_PRODUCT'),
+    ('🗑️ Удалить товар', 'DELETING_SELECT_PRODUCT'),
+    ('📅 Статистика по дате', 'SELECTING_DATE_FOR_STATS'),
+])
+def test_menu_buttons_start_declared_dialogs(bot, manager, label, state):
+    manager.add_product('Зонт', 100, 10, 300)
+    asyncio.run(bot.dialog.dispatch(make_update(label, 7), None))
+    assert bot.user_sessions.pop(7) == {'state': getattr(bot.States, state)}
+
+def test_undeclared_transition_keeps_state(bot):
+    engine = bot.DialogEngine({})
+
+    @engine.button('start', transitions=[1])
+    async def on_start(update, context):
+        return 2
+
+    @engine.state(1, transitions=[3])
+    async def on_first(update, context, session, text):
+        return 4
+
+    async def scenario():
+        await engine.dispatch(make_update('start'), None)
+        no_session = dict(engine.sessions)
+        engine.begin(1, 1)
+        await engine.dispatch(make_update('text'), None)
+        return no_session
+
+    assert asyncio.run(scenario()) == {}
+    assert engine.sessions[1] == {'state': 1}
+
+def test_every_dispatch_is_timed(bot, manager):
+    engine = bot.DialogEngine({})
+    calls = []
+    engine.add_timing_hook(lambda key, elapsed: calls.append(key))
+
+    @engine.button('start', transitions=[bot.States.WAITING_COST])
+    async def on_start(update, context):
+        return bot.States.WAITING_COST
+
+    @engine.state(bot.States.WAITING_COST, validator=bot.parse_amount, error='bad', transitions=[bot.END])
+    async def on_cost(update, context, session, value):
+        raise RuntimeError('boom')
+
+    async def scenario():
+        await engine.dispatch(make_update('hello'), None)
+        await engine.dispatch(make_update('start'), None)
+        await engine.dispatch(make_update('abc'), None)
+        with pytest.raises(RuntimeError):
+            await engine.dispatch(make_update('100'), None)
+
+    asyncio.run(scenario())
+    assert calls == ['fallback', 'button:start', 'state:WAITING_COST', 'state:WAITING_COST']
+    assert engine.timings['state:WAITING_COST']['count'] == 2
+
+def test_add_product_with_zero_price_finishes_dialog(bot, manager):
+    async def scenario():
+        await bot.dialog.dispatch(make_update('📦 Добавить товар', 5), None)
+        for text in ['Подарок', '100', '0', '0', '-']:
+            await bot.dialog.dispatch(make_update(text, 5), None)
+
+    asyncio.run(scenario())
+    assert 5 not in bot.user_sessions
+    assert manager.get_total_count() == 1
+    replies = [item.kwargs.get('text', '') for item in bot.outbound_queue._queue._queue]
+    assert any('Рентабельность: *0.0%*' in text for text in replies)
@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from conftest import FakeBot
+
+async def drain(queue, timeout=5):
+    """Ожидание отправки всех сообщений очереди"""
+    deadline = time.monotonic() + timeout
+    while queue._pending and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    assert not queue._pending
+
+def test_messages_to_one_chat_are_merged(bot):
+    async def scenario():
+        fake = FakeBot()
+        queue = bot.OutboundQueue()
+        futures = [queue.enqueue(1, 'send_message', text=f'msg {i}') for i in range(3)]
+        queue.start(fake)
+        await drain(queue)
+        await queue.stop()
+        return fake, queue, await asyncio.gather(*futures)
+
+    fake, queue, results = asyncio.run(scenario())
+    assert [call.text for call in fake.calls] == ['msg 0\n\nmsg 1\n\nmsg 2']
+    assert queue.metrics['merged'] == 2
+    # Все вызывающие получают одно и то же отправленное сообщение
+    assert len({id(result) for result in results}) == 1
+
+def test_inline_keyboards_and_priorities_are_not_merged(bot):
+    markup = InlineKeyboardMarkup([[InlineKeyboardButton('1', callback_data='list:1')]])
+
+    async def scenario():
+        fake = FakeBot(flood_limit=10)
+        queue = bot.OutboundQueue()
+        queue.enqueue(1, 'send_message', bot.Priority.NORMAL, text='plain')
+        queue.enqueue(1, 'send_message', bot.Priority.NORMAL, text='page', reply_markup=markup)
+        queue.enqueue(2, 'send_message', bot.Priority.HIGH, text='high')
+        queue.start(fake)
+        await drain(queue)
+        await queue.stop()
+        return fake
+
+    fake = asyncio.run(scenario())
+    assert sorted(call.text for call in fake.calls) == ['high', 'page', 'plain']
+    assert fake.calls[0].text == 'high'
+
+def test_repeated_edit_replaces_pending_one_and_keeps_heap_order(bot):
+    async def scenario():
+        fake = FakeBot(flood_limit=10)
+        queue = bot.OutboundQueue()
+        queue.enqueue(1, 'edit_message_text', bot.Priority.LOW, message_id=7, text='old')
+        queue.enqueue(2, 'send_message', bot.Priority.NORMAL, text='other')
+        queue.enqueue(1, 'edit_message_text', bot.Priority.HIGH, message_id=7, text='new')
+        heap_before = list(queue._queue._queue)
+        queue.start(fake)
+        await drain(queue)
+        await queue.stop()
+        return fake, heap_before
+
+    fake, heap_before = asyncio.run(scenario())
+    assert [(call.method, call.text) for call in fake.calls] == [
+        ('send_message', 'other'), ('edit_message_text', 'new')
+    ]
+    assert all(not heap_before[(i - 1) // 2] > item for i, item in enumerate(heap_before) if i)
+
+def test_chat_is_throttled_by_token_bucket(bot):
+    async def scenario():
+        fake = FakeBot(flood_limit=100)
+        queue = bot.OutboundQueue()
+        queue.CHAT_RATE = 20
+        queue.CHAT_BURST = 2
+        # Разный parse_mode не дает сообщениям склеиться
+        for i in range(5):
+            queue.enqueue(1, 'send_message', text=str(i), parse_mode=None if i % 2 else 'Markdown')
+        queue.start(fake)
+        await drain(queue)
+        await queue.stop()
+        return fake
+
+    fake = asyncio.run(scenario())
+    assert [call.text for call in fake.calls] == ['0', '1', '2', '3', '4']
+    # После пачки из CHAT_BURST сообщения идут не чаще CHAT_RATE в секунду
+    gaps = [b.sent_at - a.sent_at for a, b in zip(fake.calls[1:], fake.calls[2:])]
+    assert all(gap >= 1 / 20 * 0.8 for gap in gaps)
+
+def test_retry_after_pauses_and_resends_in_order(bot):
+    async def scenario():
+        fake = FakeBot(flood_limit=1)
+        queue = bot.OutboundQueue()
+        for i in range(3):
+            queue.enqueue(1, 'send_message', text=str(i), parse_mode=None if i % 2 else 'Markdown')
+        started = time.monotonic()
+        queue.start(fake)
+        await drain(queue, timeout=10)
+        await queue.stop()
+        return fake, queue, time.monotonic() - started
+
+    fake, queue, elapsed = asyncio.run(scenario())
+    assert [call.text for call in fake.calls] == ['0', '1', '2']
+    assert queue.metrics['retries'] >= 1
+    assert queue.metrics['failed'] == 0
+    assert elapsed >= 1
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+def test_undo_reverts_own_update(manager):
+    product = manager.add_product('Зонт', 100, 10, 300, user_id=1)
+    manager.update_product_field(product['id'], 'cost', 150, user_id=2)
+
+    event, ok = manager.undo_last_change(2)
+    assert ok and event['type'] == 'update'
+    assert manager.get_product(product['id'])['cost'] == 100
+
+def test_undo_does_not_overwrite_later_edit_of_same_field(manager):
+    product = manager.add_product('Зонт', 100, 10, 300, user_id=1)
+    manager.update_product_field(product['id'], 'cost', 150, user_id=2)
+    manager.update_product_field(product['id'], 'cost', 200, user_id=1)
+
+    event, ok = manager.undo_last_change(2)
+    assert not ok and event['type'] == 'update'
+    assert manager.get_product(product['id'])['cost'] == 200
+    assert manager.get_product(product['id'])['profit'] == 90
+
+def run_rollup_job(bot):
+    asyncio.run(bot.rollup_job(None))
+
+def recomputed(bot, products):
+    totals = bot.empty_totals()
+    for product in products:
+        bot.add_to_totals(totals, product)
+    return totals
+
+def assert_statistics_match(bot, manager):
+    stats = manager.get_statistics()
+    expected = recomputed(bot, manager.products)
+    assert stats['total_products'] == expected['count']
+    assert stats['total_final'] == expected['total_final']
+    assert stats['total_profit'] == expected['total_profit']
+
+@pytest.fixture
+def may(clock):
+    """Начало работы 10 мая 2025"""
+    clock.set('2025-05-10 12:00')
+    return clock
+
+def test_nightly_job_freezes_finished_days_and_months(bot, may, manager):
+    manager.add_product('A', 100, 10, 300)
+    manager.add_product('B', 100, 10, 200)
+
+    may.set('2025-05-11 00:05')
+    run_rollup_job(bot)
+    assert manager.rollups.frozen_until == '2025-05-11'
+    assert manager.rollups.daily['2025-05-10']['count'] == 2
+    assert manager.rollups.daily['2025-05-10']['total_profit'] == 280
+    assert '2025-05' not in manager.rollups.monthly
+
+    # Новый день считается живьем поверх замороженных
+    manager.add_product('C', 50, 0, 100)
+    assert_statistics_match(bot, manager)
+    assert manager.get_statistics_by_date('2025-05-10')['2025-05-10']['count'] == 2
+
+    may.set('2025-06-01 00:05')
+    run_rollup_job(bot)
+    assert manager.rollups.monthly['2025-05']['count'] == 3
+    assert manager.rollups.daily['2025-05-11']['total_profit'] == 50
+    assert_statistics_match(bot, manager)
+
+def test_startup_catches_up_days_missed_while_offline(bot, may, manager):
+    manager.add_product('A', 100, 10, 300)
+    may.advance(days=1)
+    manager.add_product('B', 100, 10, 200)
+
+    # Бот был выключен до 3 июня: заморозка догоняет все пропущенные дни
+    may.set('2025-06-03 09:00')
+    restarted = bot.ProductManager()
+    assert restarted.rollups.frozen_until == '2025-06-03'
+    assert sorted(restarted.rollups.daily) == ['2025-05-10', '2025-05-11']
+    assert restarted.rollups.monthly['2025-05']['total_profit'] == 280
+    assert_statistics_match(bot, restarted)
+
+def test_edit_and_delete_of_past_product_correct_frozen_rows(bot, may, manager):
+    kept = manager.add_product('A', 100, 10, 300)
+    deleted = manager.add_product('B', 100, 10, 200)
+    may.set('2025-06-02 00:05')
+    run_rollup_job(bot)
+
+    manager.update_product_field(kept['id'], 'final_price', 500)
+    assert manager.rollups.daily['2025-05-10']['total_final'] == 700
+    assert manager.rollups.monthly['2025-05']['total_profit'] == 480
+
+    manager.delete_product(deleted['id'])
+    assert manager.rollups.daily['2025-05-10']['count'] == 1
+    assert manager.rollups.monthly['2025-05'] == manager.rollups.daily['2025-05-10']
+    assert_statistics_match(bot, manager)
+
+    # Поправки сохраняются вместе с товарами
+    manager.delete_product(kept['id'])
+    assert '2025-05-10' not in bot.RollupStore().daily
+    assert manager.get_statistics() is None
@@ -0,0 +1,94 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+
+from conftest import make_product
+
+def random_products(rng, count, first_date, days):
+    """Товары с различными значениями, по дням в хронологическом порядке"""
+    dates = sorted(
+        (date.fromisoformat(first_date) + timedelta(days=rng.randrange(days))).isoformat()
+        for _ in range(count)
+    )
+    return [
+        make_product(
+            i + 1, day,
+            cost=rng.uniform(10, 500), expenses=rng.uniform(0, 50), final_price=rng.uniform(0, 800)
+        )
+        for i, day in enumerate(dates)
+    ]
+
+def expected_top(bot, ranking, products, n, start_date=None, end_date=None):
+    if start_date is not None:
+        products = [p for p in products if start_date <= p['date'] <= end_date]
+    return [p['name'] for p in sorted(products, key=lambda p: bot.ranking_key(ranking, p))[:n]]
+
+def names(products):
+    return [p['name'] for p in products]
+
+@pytest.mark.parametrize('ranking', ['top_profit', 'low_profit', 'top_expenses', 'low_margin'])
+def test_top_walks_heaps_best_first_and_skips_stale_entries(bot, ranking):
+    rng = random.Random(ranking)
+    products = random_products(rng, 200, '2025-05-01', 30)
+    index = bot.RankingIndex()
+    index.rebuild(products)
+
+    # Изменение - это удаление и повторное добавление: старые записи остаются в кучах
+    for product in rng.sample(products, 40):
+        index.remove(product)
+        product['profit'] = rng.uniform(-100, 300)
+        product['expenses'] = rng.uniform(0, 50)
+        index.add(product)
+    removed = rng.sample(products, 30)
+    for product in removed:
+        index.remove(product)
+    live = [p for p in products if p not in removed]
+
+    assert index._stale == 70
+    for n in (1, 10, 250):
+        assert names(index.top(ranking, n)) == expected_top(bot, ranking, live, n)
+    for start, end in [('2025-05-10', '2025-05-10'), ('2025-05-03', '2025-05-17'), ('2025-06-01', '2025-06-30')]:
+        assert names(index.top(ranking, 10, start, end)) == expected_top(bot, ranking, live, 10, start, end)
+
+def test_heaps_are_rebuilt_when_stale_entries_outnumber_live(bot):
+    products = random_products(random.Random(1), 100, '2025-05-01', 10)
+    index = bot.RankingIndex()
+    index.rebuild(products)
+
+    for product in products[:82]:
+        index.remove(product)
+    # 82 устаревших записи - еще не больше 18 живых + 64
+    assert index._stale == 82
+    assert len(index._heaps['top_profit']) == 100
+
+    index.remove(products[82])
+    assert index._stale == 0
+    assert len(index._heaps['top_profit']) == 17
+    assert sum(len(heaps['top_profit']) for heaps in index._day_heaps.values()) == 17
+    assert names(index.top('top_profit', 20)) == expected_top(bot, 'top_profit', products[83:], 20)
+
+@pytest.fixture
+def archive(bot, clock, seed):
+    """Товары с марта по 15 июля 2025: март-май уходят в архивные сегменты"""
+    clock.set('2025-07-15 12:00')
+    products = random_products(random.Random(7), 300, '2025-03-01', 137)
+    manager = seed(products)
+    assert [meta['month'] for meta in manager.cold.segments] == ['2025-03', '2025-04', '2025-05']
+    return manager, products
+
+@pytest.mark.parametrize('ranking', ['top_profit', 'low_profit', 'top_expenses', 'low_margin'])
+@pytest.mark.parametrize('window', [
+    (None, None),
+    ('2025-07-01', '2025-07-31'),
+    ('2025-04-01', '2025-04-30'),
+    ('2025-05-20', '2025-06-10'),
+    ('2025-07-15', '2025-07-15'),
+])
+def test_top_products_merge_live_heaps_with_segment_tops(bot, archive, ranking, window):
+    manager, products = archive
+    n = bot.SEGMENT_TOP_K
+    top = manager.get_top_products(ranking, n, *window)
+    assert names(top) == expected_top(bot, ranking, products, n, *window)
+    # Сквозные ID архивных товаров совпадают с их позицией
+    assert all(manager.get_product(p['id'])['name'] == p['name'] for p in top)
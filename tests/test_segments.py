@@ -0,0 +1,65 @@
+import json
+import os
+
+import pytest
+
+def make_products(count):
+    """Товары за три давно закрытых месяца"""
+    products = []
+    for i in range(count):
+        date = f'2025-{5 + i * 3 // count:02d}-{i % 28 + 1:02d}'
+        products.append({
+            'id': i + 1, 'name': f'P{i}', 'cost': 100.0, 'expenses': 10.0,
+            'final_price': 150.0 + i, 'profit': 40.0 + i,
+            'created_at': f'{date} 10:00:00', 'date': date
+        })
+    return sorted(products, key=lambda p: p['date'])
+
+def test_edits_of_archived_products_do_not_leave_stale_versions(bot, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open('products.json', 'w', encoding='utf-8') as f:
+        json.dump(make_products(60), f)
+    manager = bot.ProductManager()
+    assert manager.cold.total_count == 60 and not manager.products
+
+    for _ in range(15):
+        manager.delete_product(1, user_id=1)
+    for _ in range(8):
+        manager.undo_last_change(1)
+
+    files = set(os.listdir('segments')) - {'manifest.json'}
+    current = {meta['file'] for meta in manager.cold.segments}
+    assert files == current | (manager.events.segment_files & files)
+    assert manager.events.segment_files <= files
+    assert len(files) < 15
+
+    # Снимки журнала по-прежнему восстанавливаются из оставшихся версий
+    as_of = manager.events.state_as_of('2099-01-01 00:00:00')
+    assert [p['uid'] for p in as_of] == [p['uid'] for p in manager._slice(0, manager.get_total_count())]
+
+    reloaded = bot.ProductManager()
+    assert reloaded.get_total_count() == 53
+
+@pytest.mark.parametrize('damage', ['missing', 'corrupt'])
+def test_lost_rollups_are_rebuilt_from_segment_cubes(bot, tmp_path, monkeypatch, damage):
+    monkeypatch.chdir(tmp_path)
+    products = make_products(60)
+    with open('products.json', 'w', encoding='utf-8') as f:
+        json.dump(products, f)
+    bot.ProductManager()
+
+    if damage == 'missing':
+        os.remove('rollups.json')
+    else:
+        with open('rollups.json', 'w', encoding='utf-8') as f:
+            f.write('{"frozen_until": ')
+    manager = bot.ProductManager()
+
+    stats = manager.get_statistics()
+    assert stats['total_products'] == 60
+    assert stats['total_profit'] == sum(p['profit'] for p in products)
+    day = manager.get_statistics_by_date('2025-05-01')['2025-05-01']
+    assert day['count'] == len(day['products']) == sum(p['date'] == '2025-05-01' for p in products)
+    assert manager.rollups.monthly['2025-06']['count'] == sum(p['date'].startswith('2025-06') for p in products)
+    # Восстановленные агрегаты сохранены для следующего запуска
+    assert bot.RollupStore().daily == manager.rollups.daily
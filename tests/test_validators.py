@@ -0,0 +1,27 @@
+import pytest
+
+@pytest.mark.parametrize('text', ['nan', 'NaN', 'inf', '-inf', '1e999', 'abc', ''])
+def test_parse_amount_rejects_non_finite_and_garbage(bot, text):
+    with pytest.raises(ValueError):
+        bot.parse_amount(text)
+
+def test_parse_amount_accepts_numbers(bot):
+    assert bot.parse_amount('12.5') == 12.5
+    assert bot.parse_amount('-3') == -3
+
+def test_parse_tag_limits_callback_data_bytes(bot):
+    # 14 эмодзи - меньше 20 символов, но 56 байт: кнопка tag:month:... не влезла бы в 64 байта
+    with pytest.raises(ValueError):
+        bot.parse_tag('😀' * 14)
+    tag = bot.parse_tag('поставщик Иванов')
+    assert all(len(bot.tag_callback(window, tag).encode('utf-8')) <= 64 for window in bot.RANKING_WINDOWS)
+
+def test_tag_statistics_keyboard_fits_callback_limit(bot, manager):
+    # Тег из старых данных, записанный до проверки по байтам
+    manager.add_product('Зонт', 100, 10, 300, tag='😀' * 14)
+    manager.add_product('Зонт', 100, 10, 300, tag='опт')
+    for window in bot.RANKING_WINDOWS:
+        _, markup = bot.build_tag_statistics(window)
+        data = [button.callback_data for row in markup.inline_keyboard for button in row]
+        assert f'tag:{window}:опт' in data
+        assert all(len(item.encode('utf-8')) <= 64 for item in data)